@@ -0,0 +1,49 @@
+import asyncio
+import json
+
+import aiohttp
+from telegram.error import BadRequest, ChatMigrated, InvalidToken, NetworkError, RetryAfter, TimedOut, Unauthorized
+
+API_URL = "https://api.telegram.org/bot"
+
+
+class AsyncBot:
+    # Cliente mínimo y asíncrono de la Bot API para enviar avisos. Usa la sesión HTTP del fetcher (conexiones
+    # keep-alive reutilizadas) y corre en su event loop. Los errores se entregan como las mismas excepciones de
+    # python-telegram-bot, para manejarlos igual que en try_msg.
+
+    def __init__(self, token, fetcher, base_url=API_URL):
+        self.fetcher = fetcher
+        self.url = "{}{}/".format(base_url, token)
+
+    async def _post(self, method, params):
+        try:
+            response = await self.fetcher.post(self.url + method, params)
+        except asyncio.TimeoutError:
+            raise TimedOut()
+        except aiohttp.ClientError as e:
+            raise NetworkError("{}: {}".format(type(e).__name__, e))
+        try:
+            result = json.loads(response.body.decode("utf-8"))
+        except ValueError:
+            raise NetworkError("Invalid server response (HTTP {})".format(response.status))
+        if result.get("ok"):
+            return result["result"]
+
+        description = result.get("description", "Unknown HTTPError")
+        parameters = result.get("parameters") or {}
+        if "migrate_to_chat_id" in parameters:
+            raise ChatMigrated(parameters["migrate_to_chat_id"])
+        if "retry_after" in parameters:
+            raise RetryAfter(parameters["retry_after"])
+        if response.status in (401, 403):
+            raise Unauthorized(description)
+        if response.status == 400:
+            raise BadRequest(description)
+        if response.status == 404:
+            raise InvalidToken()
+        raise NetworkError("{} (HTTP {})".format(description, response.status))
+
+    async def send_message(self, **params):
+        params.pop("force", None)
+        return await self._post("sendMessage", params)
@@ -0,0 +1,69 @@
+# Compara los parsers de parsers.PARSERS sobre páginas del catálogo guardadas localmente.
+#
+# Uso:
+#   python benchmarks/bench_parser.py --record excluded/pages   # descarga las páginas actuales de U-Campus
+#   python benchmarks/bench_parser.py excluded/pages/*.html     # compara resultados y tiempos
+#
+# Falla si algún parser entrega un resultado distinto al de "soup" para alguna página.
+import argparse
+import json
+import sys
+import time
+import urllib.request
+from os import makedirs, path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from constants import DEPTS, YEAR, SEMESTER  # noqa: E402
+from parsers import PARSERS  # noqa: E402
+
+
+def record(directory):
+    makedirs(directory, exist_ok=True)
+    for dept_id in DEPTS:
+        url = "https://ucampus.uchile.cl/m/fcfm_catalogo/?semestre={}{}&depto={}".format(YEAR, SEMESTER, dept_id)
+        with urllib.request.urlopen(url) as response:
+            body = response.read()
+        with open(path.join(directory, "depto-{}.html".format(dept_id)), "wb") as page_file:
+            page_file.write(body)
+        print("Saved {} ({} bytes)".format(dept_id, len(body)))
+
+
+def bench(files, repeat):
+    totals = {name: 0.0 for name in PARSERS}
+    for filename in files:
+        with open(filename, "r", encoding="utf-8") as page_file:
+            html = page_file.read()
+        outputs = {}
+        times = {}
+        for name, parse_depto in PARSERS.items():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                outputs[name] = parse_depto(html)
+            times[name] = (time.perf_counter() - start) / repeat
+            totals[name] += times[name]
+        reference = json.dumps(outputs["soup"].to_json(), indent=4)
+        for name, output in outputs.items():
+            if json.dumps(output.to_json(), indent=4) != reference:
+                print("{}: '{}' output differs from 'soup'".format(filename, name))
+                return 1
+        print("{:<40} {:>8} bytes  ".format(path.basename(filename), len(html)) +
+              "  ".join("{}: {:8.2f} ms".format(name, t * 1000) for name, t in times.items()))
+    print("Total".ljust(58) + "  ".join("{}: {:8.2f} ms".format(name, t * 1000) for name, t in totals.items()))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="*")
+    parser.add_argument("--record", metavar="DIR")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    if args.record:
+        record(args.record)
+        return 0
+    return bench(args.files, args.repeat)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
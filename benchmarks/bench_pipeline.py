@@ -0,0 +1,287 @@
+# Mide, sin conexión, cada etapa de un check: parse, diff, match (chats suscritos), render y fan-out.
+#
+# Uso:
+#   python benchmarks/bench_pipeline.py                                # catálogo sintético con todos los deptos
+#   python benchmarks/bench_pipeline.py --pages excluded/pages         # páginas guardadas con bench_parser.py --record
+#   python benchmarks/bench_pipeline.py --json bench.json              # guarda los resultados
+#   python benchmarks/bench_pipeline.py --json new.json --compare bench.json
+#
+# El catálogo "anterior" son las páginas guardadas (depto-<id>.html) o, si no se indican, páginas sintéticas de
+# --cursos cursos por depto (ver fixtures.py). El catálogo "nuevo" se obtiene mutando cada depto con --added,
+# --deleted y --modified cursos. Las páginas nuevas se generan con la misma estructura, así que el parse se mide
+# sobre ambas.
+# El fan-out usa el Notifier real con un bot falso que sólo espera --send-latency segundos por mensaje. Por
+# defecto no hay límite de envío, para medir el costo propio del notifier; con --rate 30 --chat-interval 1 se
+# simulan los límites de Telegram. Necesita config/auth.py (el token no se usa), si no, la etapa se omite.
+#
+# Para cada etapa se reporta la latencia por ítem (página, depto, mensaje), el tiempo total (mediana de --repeat
+# repeticiones), el throughput y el peak de memoria medido con tracemalloc en una repetición aparte. Todo sale de
+# una semilla, así que dos ejecuciones con los mismos argumentos procesan exactamente los mismos datos.
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import platform
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from constants import DEPTS  # noqa: E402
+from diff import diff_depto  # noqa: E402
+from fixtures import depto_to_html, mutate, random_catalog, random_chats  # noqa: E402
+from parsers import PARSERS, parse_and_fingerprint  # noqa: E402
+from render import ChangeRenderer  # noqa: E402
+from subscription_index import SubscriptionIndex  # noqa: E402
+
+MESSAGE_PARAMS = {"parse_mode": "HTML", "disable_web_page_preview": True}
+STAGES = ["parse", "diff", "match", "render", "fanout"]
+
+
+def load_pages(args):
+    rng = random.Random(args.seed)
+    if args.pages:
+        pages = {}
+        for filename in sorted(glob.glob(path.join(args.pages, "depto-*.html"))):
+            d_id = re.match(r"depto-(.+)\.html$", path.basename(filename)).group(1)
+            with open(filename, "r", encoding="utf-8") as page_file:
+                pages[d_id] = page_file.read()
+        if not pages:
+            raise SystemExit("No depto-*.html pages in {}".format(args.pages))
+    else:
+        d_ids = sorted(DEPTS)[:args.deptos] if args.deptos else sorted(DEPTS)
+        pages = {d_id: depto_to_html(depto) for d_id, depto in random_catalog(rng, args.cursos, d_ids).items()}
+    old_catalog = {d_id: PARSERS[args.parser](html) for d_id, html in pages.items()}
+    new_catalog = {d_id: mutate(rng, depto, args.added, args.deleted, args.modified)
+                   for d_id, depto in old_catalog.items()}
+    new_pages = {d_id: depto_to_html(depto) for d_id, depto in new_catalog.items()}
+    return pages, new_pages, old_catalog, new_catalog
+
+
+class FakeBot:
+    # Hace las veces de AsyncBot (async_bot.py): no envía nada, sólo espera latency segundos y anota la hora
+    def __init__(self, latency):
+        self.latency = latency
+        self.sent = []
+
+    async def send_message(self, **params):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent.append(time.perf_counter())
+
+
+class Pipeline:
+    def __init__(self, args):
+        self.args = args
+        (self.pages, self.new_pages, self.old_catalog, self.new_catalog) = load_pages(args)
+        self.old_fingerprints = {}
+        self.new_fingerprints = {}
+        self.all_changes = {}
+        self.chats = random_chats(random.Random(args.seed), self.old_catalog, args.chats)
+        self.subscriptions = SubscriptionIndex()
+        self.subscriptions.rebuild(self.chats)
+        self.matches = {}
+        self.messages = []
+        self.notifier = None
+        self.fake_bot = None
+
+    # Cada etapa entrega la latencia de cada ítem procesado, en segundos
+    def parse(self):
+        latencies = []
+        for pages, fingerprints in ((self.pages, self.old_fingerprints), (self.new_pages, self.new_fingerprints)):
+            for d_id, html in pages.items():
+                start = time.perf_counter()
+                (_, fingerprints[d_id]) = parse_and_fingerprint(self.args.parser, html)
+                latencies.append(time.perf_counter() - start)
+        return latencies
+
+    def diff(self):
+        latencies = []
+        self.all_changes = {}
+        for d_id, old_depto in self.old_catalog.items():
+            start = time.perf_counter()
+            changes = diff_depto(old_depto, self.new_catalog[d_id], self.old_fingerprints[d_id],
+                                 self.new_fingerprints[d_id])
+            latencies.append(time.perf_counter() - start)
+            if changes:
+                self.all_changes[d_id] = changes
+        return latencies
+
+    # Como en bot.check_depto, los chats suscritos se buscan depto por depto
+    def match(self):
+        latencies = []
+        self.matches = {}
+        for d_id, changes in self.all_changes.items():
+            start = time.perf_counter()
+            self.matches[d_id] = self.subscriptions.matches({d_id: changes})
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    # Lo mismo que bot.notify_changes y bot.send_notices, sin el outbox: cada chat recibe juntos los avisos de
+    # todos los deptos del check
+    def render(self):
+        self.messages = []
+        start = time.perf_counter()
+        renderer = ChangeRenderer(self.all_changes, self.old_catalog, self.new_catalog)
+        chat_blocks = {}
+        for d_id in self.all_changes:
+            for chat_id, (dept_matches, curso_matches) in self.matches[d_id].items():
+                chat_blocks.setdefault(chat_id, []).extend(
+                    [(x, None) for x in dept_matches] +
+                    [(x, c_id) for (x, c_id) in curso_matches if x not in dept_matches])
+        for chat_id, blocks in chat_blocks.items():
+            for message in renderer.messages(blocks):
+                self.messages.append((chat_id, message))
+        return [time.perf_counter() - start]
+
+    def start_notifier(self):
+        # notifier.py importa data.py, que abre la persistencia y crea el Updater: se hace en un directorio
+        # temporal para no tocar la base de datos del bot
+        cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+        try:
+            from notifier import Notifier
+        finally:
+            os.chdir(cwd)
+        logging.getLogger("CatalogoFCFMBot").setLevel(logging.WARNING)
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="Notifier", daemon=True).start()
+        self.fake_bot = FakeBot(self.args.send_latency)
+        self.notifier = Notifier(self.fake_bot, self.loop, workers=self.args.workers, rate=self.args.rate,
+                                 chat_interval=self.args.chat_interval)
+
+    def stop_notifier(self):
+        if self.notifier is not None:
+            self.notifier.close()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.tmpdir.cleanup()
+
+    def fanout(self):
+        from outbox import Message
+        self.fake_bot.sent = []
+        start = time.perf_counter()
+        fanout = self.notifier.send("bench", [Message(None, chat_id, text, MESSAGE_PARAMS)
+                                              for (chat_id, text) in self.messages])
+        fanout.wait()
+        return [x - start for x in self.fake_bot.sent]
+
+
+def summarize(latencies, totals, peak):
+    total = statistics.median(totals)
+    items = len(latencies) // len(totals)
+    result = {"items": items,
+              "total_ms": round(total * 1000, 3),
+              "throughput_per_s": round(items / total, 1) if total > 0 else None,
+              "peak_memory_kb": round(peak / 1024, 1)}
+    if latencies:
+        latencies = sorted(latencies)
+        result["latency_ms"] = {"mean": round(statistics.mean(latencies) * 1000, 3),
+                                "p50": round(latencies[len(latencies) // 2] * 1000, 3),
+                                "p95": round(latencies[int(len(latencies) * 0.95)] * 1000, 3),
+                                "max": round(latencies[-1] * 1000, 3)}
+    return result
+
+
+def measure(stage, repeat):
+    latencies = []
+    totals = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        latencies += stage()
+        totals.append(time.perf_counter() - start)
+    tracemalloc.start()
+    stage()
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return summarize(latencies, totals, peak)
+
+
+def run(args):
+    pipeline = Pipeline(args)
+    results = {}
+    for name in STAGES:
+        if name == "fanout":
+            try:
+                pipeline.start_notifier()
+            except ImportError as e:
+                results[name] = {"skipped": "{}: {}".format(type(e).__name__, e)}
+                continue
+        results[name] = measure(getattr(pipeline, name), args.repeat)
+    pipeline.stop_notifier()
+    return {"config": {key: value for key, value in sorted(vars(args).items()) if key not in ("json", "compare")},
+            "environment": {"python": platform.python_version(), "platform": platform.platform()},
+            "input": {"deptos": len(pipeline.pages),
+                      "cursos": sum(len(x) for x in pipeline.old_catalog.values()),
+                      "page_bytes": sum(len(x.encode("utf-8")) for x in pipeline.pages.values()),
+                      "changed_deptos": len(pipeline.all_changes),
+                      "chats": len(pipeline.chats),
+                      "messages": len(pipeline.messages)},
+            "stages": results}
+
+
+def print_results(results, previous=None):
+    print("Input: " + ", ".join("{} {}".format(value, key) for key, value in results["input"].items()))
+    for name in STAGES:
+        stage = results["stages"][name]
+        if "skipped" in stage:
+            print("{:<7} skipped ({})".format(name, stage["skipped"]))
+            continue
+        latency = stage.get("latency_ms", {})
+        line = "{:<7} {:>7} items  total {:>10.2f} ms  {:>10.1f}/s  p50 {:>8.3f} ms  p95 {:>8.3f} ms  " \
+               "peak {:>9.1f} KB".format(name, stage["items"], stage["total_ms"], stage["throughput_per_s"] or 0,
+                                          latency.get("p50", 0), latency.get("p95", 0), stage["peak_memory_kb"])
+        old = (previous or {}).get("stages", {}).get(name, {})
+        if old.get("total_ms") and old.get("peak_memory_kb"):
+            line += "  (time x{:.2f}, memory x{:.2f})".format(stage["total_ms"] / old["total_ms"],
+                                                              stage["peak_memory_kb"] / old["peak_memory_kb"])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", metavar="DIR", help="páginas guardadas con bench_parser.py --record")
+    parser.add_argument("--deptos", type=int, default=0, help="cantidad de deptos sintéticos (0: todos)")
+    parser.add_argument("--cursos", type=int, default=60, help="cursos por depto sintético")
+    parser.add_argument("--added", type=int, default=2)
+    parser.add_argument("--deleted", type=int, default=1)
+    parser.add_argument("--modified", type=int, default=5)
+    parser.add_argument("--chats", type=int, default=2000)
+    parser.add_argument("--parser", choices=sorted(PARSERS), default="soup")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=1e9)
+    parser.add_argument("--chat-interval", type=float, default=0.0)
+    parser.add_argument("--send-latency", type=float, default=0.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="FILE", help="guarda los resultados en FILE ('-' para stdout)")
+    parser.add_argument("--compare", metavar="FILE", help="resultados anteriores con qué comparar")
+    args = parser.parse_args()
+
+    results = run(args)
+    previous = None
+    if args.compare:
+        with open(args.compare, "r") as previous_file:
+            previous = json.load(previous_file)
+    if args.json == "-":
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        print_results(results, previous)
+        if args.json:
+            with open(args.json, "w") as json_file:
+                json.dump(results, json_file, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+# Revisa y mide render.split_message.
+#
+# Uso:
+#   python benchmarks/bench_split.py                 # revisa 5000 textos al azar y mide sobre diffs enormes
+#   python benchmarks/bench_split.py --cases 50000 --seed 7
+#
+# Para textos HTML al azar (tags anidados, links, saltos de línea, entidades, líneas más largas que el límite)
+# y largos máximos al azar revisa que cada trozo:
+#   - no pase del largo máximo,
+#   - tenga sus tags balanceados,
+#   - no corte un tag ni una entidad,
+# y que juntando los trozos (sin tags ni espacios) se recupere el texto original.
+# Después compara el tiempo contra el corte recursivo anterior en avisos de deptos con miles de cursos.
+import argparse
+import random
+import re
+import sys
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from model import Curso, Departamento, Horario, Seccion  # noqa: E402
+from render import ChangeRenderer, MAX_ENTITY_LENGTH, TAG_RE, split_message  # noqa: E402
+
+WORDS = ["Cátedra", "Lunes", "10:15", "-", "11:45", "S1", "cupos", "&amp;", "&lt;", "Álgebra", "x" * 60]
+TAGS = ["b", "i", "strong"]
+LINK = "https://ucampus.uchile.cl/m/fcfm_catalogo/?semestre=20221&depto=5"
+
+
+def random_html(rng, depth=0):
+    parts = []
+    for _ in range(rng.randint(1, 12)):
+        r = rng.random()
+        if r < 0.05:
+            parts.append("<a href='{}'>\U0001F50D Ver catálogo</a>".format(LINK))
+        elif r < 0.2 and depth < 3:
+            tag = rng.choice(TAGS)
+            parts.append("<{}>{}</{}>".format(tag, random_html(rng, depth + 1), tag))
+        elif r < 0.35:
+            parts.append("\n")
+        else:
+            parts.append(rng.choice(WORDS) + " ")
+    return "".join(parts)
+
+
+def check_chunk(chunk, max_length):
+    assert len(chunk) <= max_length, "chunk too long ({} > {})".format(len(chunk), max_length)
+    stack = []
+    for match in TAG_RE.finditer(chunk):
+        if match.group(1):
+            assert stack and stack[-1] == match.group(2), "unbalanced tags in {!r}".format(chunk)
+            stack.pop()
+        else:
+            stack.append(match.group(2))
+    assert not stack, "unclosed tags in {!r}".format(chunk)
+    text = TAG_RE.sub("", chunk)
+    assert "<" not in text and ">" not in text, "cut tag in {!r}".format(chunk)
+    assert not re.search(r"&[a-z]*$", text) and not re.match(r"^[a-z]*;", text), "cut entity in {!r}".format(chunk)
+
+
+def check(cases, seed):
+    rng = random.Random(seed)
+    for case in range(cases):
+        text = "".join(random_html(rng) for _ in range(rng.randint(1, 40)))
+        max_length = rng.randint(MAX_ENTITY_LENGTH, 1000)
+        chunks = split_message(text, max_length)
+        for chunk in chunks:
+            check_chunk(chunk, max_length)
+        expected = re.sub(r"\s", "", TAG_RE.sub("", text))
+        assert "".join(re.sub(r"\s", "", TAG_RE.sub("", x)) for x in chunks) == expected, "text lost in case " + str(case)
+    print("{} random cases OK".format(cases))
+
+
+def legacy_split(text, maxl):
+    # Corte recursivo anterior (utils.send_long_message), sin enviar nada
+    if len(text) > maxl:
+        slice_index = maxl
+        for i in range(maxl, -1, -1):
+            if text[i] == "\n":
+                slice_index = i
+                break
+        return [text[:slice_index]] + legacy_split(text[slice_index + 1:], maxl)
+    return [text]
+
+
+def big_depto_message(cursos):
+    horario = Horario(["Lunes 10:15 - 11:45", "Miércoles 10:15 - 11:45"], ["Viernes 14:30 - 16:00"])
+    new_depto = Departamento(("MA{:04}".format(i), Curso("Curso {}".format(i), {
+        str(j): Seccion(["Profesor {}".format(j)], str(j * 10), horario) for j in range(1, 4)})) for i in range(cursos))
+    changes = {"added": list(new_depto)}
+    return ChangeRenderer({"21": changes}, {}, {"21": new_depto}).block("21")
+
+
+def bench(repeat):
+    sys.setrecursionlimit(100000)
+    for cursos in (100, 1000, 5000):
+        text = big_depto_message(cursos)
+        times = {}
+        for name, split in (("legacy", legacy_split), ("split_message", split_message)):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                chunks = split(text, 4096)
+            times[name] = (time.perf_counter() - start) / repeat
+        print("{:>5} cursos, {:>9} chars, {:>4} chunks  ".format(cursos, len(text), len(chunks)) +
+              "  ".join("{}: {:8.2f} ms".format(name, t * 1000) for name, t in times.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    check(args.cases, args.seed)
+    bench(args.repeat)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
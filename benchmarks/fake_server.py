@@ -0,0 +1,192 @@
+# Servidor local que imita a U-Campus (catálogo), u-cursos (novedades) y la Bot API de Telegram, para pruebas
+# de carga del bot completo sin tocar los servicios reales.
+#
+# Uso:
+#   python benchmarks/fake_server.py --port 8080 --latency 0.2 --error-rate 0.02 --churn 0.1
+#   python benchmarks/seed_chats.py 10000                # chats suscritos al mismo catálogo sintético
+#
+# y en config/bot.json:
+#   "ucampus_url": "http://127.0.0.1:8080",
+#   "ucursos_url": "http://127.0.0.1:8080",
+#   "telegram_api_url": "http://127.0.0.1:8080/bot"
+#
+# El catálogo es el de fixtures.random_catalog con --seed y --cursos (el mismo que usa seed_chats.py). Cada vez
+# que se pide un depto, con probabilidad --churn se modifican --churn-cursos de sus cursos antes de responder.
+# Las páginas tienen ETag, así que las consultas condicionales del bot reciben 304 si no hubo cambios.
+# Cada --novedad-every segundos aparece una novedad nueva sobre resultados de la inscripción académica.
+# La Bot API acepta cualquier token y responde 429 con retry_after si se pasa de --rate mensajes por segundo en
+# total o de uno cada --chat-interval segundos a un mismo chat, como Telegram.
+# GET /stats entrega contadores de todo lo anterior, incluyendo cuándo se envió el primer y el último mensaje.
+import argparse
+import asyncio
+import hashlib
+import math
+import random
+import sys
+import time
+from os import path
+
+from aiohttp import web
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from fixtures import depto_to_html, mutate, random_catalog  # noqa: E402
+
+NOVEDAD_TITLES = ["Resultados de la modificación de inscripción académica",
+                  "Calendario de actividades del semestre",
+                  "Resultados de la inscripción académica"]
+
+
+def _etag(body):
+    return '"{}"'.format(hashlib.sha1(body.encode("utf-8")).hexdigest())
+
+
+class FakeServer:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.catalog = random_catalog(self.rng, args.cursos)
+        self.pages = {d_id: self._page(depto) for d_id, depto in self.catalog.items()}
+        self.novedad_id = 50000
+        self.novedad_time = time.monotonic()
+        self.tokens = args.rate
+        self.tokens_time = time.monotonic()
+        self.last_chat_message = {}
+        self.stats = {"catalog_requests": 0, "catalog_not_modified": 0, "catalog_errors": 0, "catalog_changes": 0,
+                      "novedades_requests": 0, "novedades": 0,
+                      "bot_requests": 0, "messages_sent": 0, "retry_after": 0, "chats": 0,
+                      "first_message": None, "last_message": None}
+
+    @staticmethod
+    def _page(depto):
+        html = depto_to_html(depto)
+        return html, _etag(html)
+
+    async def _delay(self):
+        if self.args.latency:
+            await asyncio.sleep(self.rng.uniform(0.5, 1.5) * self.args.latency)
+
+    def _error(self):
+        return self.rng.random() < self.args.error_rate
+
+    @staticmethod
+    def _conditional(request, html, etag):
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(text=html, content_type="text/html", charset="utf-8", headers={"ETag": etag})
+
+    async def catalogo(self, request):
+        self.stats["catalog_requests"] += 1
+        await self._delay()
+        d_id = request.query.get("depto")
+        if d_id not in self.catalog:
+            raise web.HTTPNotFound()
+        if self._error():
+            self.stats["catalog_errors"] += 1
+            raise web.HTTPServiceUnavailable()
+        if self.rng.random() < self.args.churn:
+            self.catalog[d_id] = mutate(self.rng, self.catalog[d_id], modified=self.args.churn_cursos)
+            self.pages[d_id] = self._page(self.catalog[d_id])
+            self.stats["catalog_changes"] += 1
+        (html, etag) = self.pages[d_id]
+        response = self._conditional(request, html, etag)
+        if response.status == 304:
+            self.stats["catalog_not_modified"] += 1
+        return response
+
+    async def novedades(self, request):
+        self.stats["novedades_requests"] += 1
+        await self._delay()
+        if self._error():
+            raise web.HTTPServiceUnavailable()
+        if self.args.novedad_every and time.monotonic() - self.novedad_time >= self.args.novedad_every:
+            self.novedad_id += 1
+            self.novedad_time = time.monotonic()
+            self.stats["novedades"] += 1
+        title = NOVEDAD_TITLES[self.novedad_id % len(NOVEDAD_TITLES)]
+        html = ("<html><body><div class=\"objeto\" data-id=\"{0}\">\n<h1><a href=\"/novedades/{0}\">{1}</a></h1>\n"
+                "</div></body></html>\n".format(self.novedad_id, title))
+        return self._conditional(request, html, _etag(html))
+
+    # Entrega cuántos segundos debe esperar chat_id antes de enviar otro mensaje, o 0 si puede enviarlo ahora
+    def _retry_after(self, chat_id):
+        now = time.monotonic()
+        self.tokens = min(self.args.rate, self.tokens + (now - self.tokens_time) * self.args.rate)
+        self.tokens_time = now
+        wait = self.last_chat_message.get(chat_id, -math.inf) + self.args.chat_interval - now
+        if wait > 0:
+            return wait
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.args.rate
+        self.tokens -= 1
+        self.last_chat_message[chat_id] = now
+        return 0
+
+    async def bot_api(self, request):
+        self.stats["bot_requests"] += 1
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(request.query)
+            params.update(await request.post())
+        if method == "getUpdates":
+            await asyncio.sleep(min(float(params.get("timeout", 0)), 10))
+            return web.json_response({"ok": True, "result": []})
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Fake",
+                                                             "username": "fake_bot"}})
+        if method in ("deleteWebhook", "setWebhook"):
+            return web.json_response({"ok": True, "result": True})
+        if method not in ("sendMessage", "sendDocument"):
+            return web.json_response({"ok": False, "error_code": 404, "description": "Not Found"}, status=404)
+
+        await asyncio.sleep(self.args.bot_latency)
+        chat_id = int(params["chat_id"])
+        retry_after = self._retry_after(chat_id)
+        if retry_after > 0:
+            self.stats["retry_after"] += 1
+            return web.json_response({"ok": False, "error_code": 429,
+                                      "description": "Too Many Requests: retry after {}".format(math.ceil(retry_after)),
+                                      "parameters": {"retry_after": math.ceil(retry_after)}}, status=429)
+        now = time.time()
+        self.stats["messages_sent"] += 1
+        self.stats["chats"] = len(self.last_chat_message)
+        self.stats["first_message"] = self.stats["first_message"] or now
+        self.stats["last_message"] = now
+        return web.json_response({"ok": True, "result": {"message_id": self.stats["messages_sent"], "date": int(now),
+                                                         "chat": {"id": chat_id, "type": "private"},
+                                                         "text": params.get("text", "")}})
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cursos", type=int, default=60, help="cursos por depto")
+    parser.add_argument("--latency", type=float, default=0.0, help="latencia media de U-Campus y u-cursos (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fracción de respuestas HTTP 503")
+    parser.add_argument("--churn", type=float, default=0.0, help="probabilidad de que un depto cambie al pedirlo")
+    parser.add_argument("--churn-cursos", type=int, default=3, help="cursos modificados en cada cambio")
+    parser.add_argument("--novedad-every", type=float, default=0.0, help="segundos entre novedades (0: nunca)")
+    parser.add_argument("--rate", type=float, default=30, help="mensajes por segundo en total")
+    parser.add_argument("--chat-interval", type=float, default=1.0, help="segundos entre mensajes a un chat")
+    parser.add_argument("--bot-latency", type=float, default=0.0, help="latencia de la Bot API (s)")
+    args = parser.parse_args()
+
+    server = FakeServer(args)
+    app = web.Application()
+    app.router.add_get("/m/fcfm_catalogo/", server.catalogo)
+    app.router.add_get("/ingenieria/2/novedades_institucion/", server.novedades)
+    app.router.add_route("*", "/bot{token}/{method}", server.bot_api)
+    app.router.add_get("/stats", server.get_stats)
+    web.run_app(app, host=args.host, port=args.port)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,119 @@
+# Catálogos sintéticos para los benchmarks y pruebas de carga.
+#
+# random_depto() arma un Departamento al azar (con una semilla, siempre el mismo), mutate() le añade, elimina y
+# modifica cursos como pasaría entre dos consultas, y depto_to_html() lo convierte en una página con la misma
+# estructura que fcfm_catalogo de U-Campus, que los parsers de parsers.py leen de vuelta sin diferencias.
+from html import escape
+
+from constants import DEPTS
+from model import Curso, Departamento, Horario, Seccion
+
+DIAS = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes"]
+BLOQUES = [("08:30", "10:00"), ("10:15", "11:45"), ("12:00", "13:30"), ("14:30", "16:00"), ("16:15", "17:45")]
+NOMBRES = ["Álgebra", "Cálculo", "Programación", "Mecánica", "Termodinámica", "Economía", "Optimización",
+           "Electromagnetismo", "Estadística", "Geología", "Materiales", "Diseño", "Redes", "Métodos"]
+APELLIDOS = ["González", "Muñoz", "Rojas", "Díaz", "Pérez", "Soto", "Contreras", "Silva", "Martínez", "Sepúlveda"]
+
+
+def random_bloques(rng, count):
+    return ["{} {} - {}".format(rng.choice(DIAS), *rng.choice(BLOQUES)) for _ in range(count)]
+
+
+def random_horario(rng):
+    control = random_bloques(rng, rng.randint(0, 1))
+    semanas = sorted(rng.sample(range(1, 16), rng.randint(1, 4))) if control else []
+    return Horario(random_bloques(rng, rng.randint(1, 3)), random_bloques(rng, rng.randint(0, 2)),
+                   control, [str(x) for x in semanas])
+
+
+def random_seccion(rng):
+    profesores = ["{} {}".format(rng.choice(APELLIDOS), rng.choice(APELLIDOS)) for _ in range(rng.randint(1, 3))]
+    return Seccion(profesores, str(rng.randint(10, 120)), random_horario(rng))
+
+
+def random_curso(rng, i):
+    nombre = "{} {}".format(rng.choice(NOMBRES), i)
+    return Curso(nombre, {str(j): random_seccion(rng) for j in range(1, rng.randint(1, 6) + 1)})
+
+
+def random_depto(rng, cursos, prefix="CC"):
+    return Departamento(("{}{:04}".format(prefix, i), random_curso(rng, i)) for i in range(cursos))
+
+
+# {id de depto: Departamento} con cursos cursos en cada uno de los deptos d_ids (por defecto, todos)
+def random_catalog(rng, cursos, d_ids=None):
+    return {d_id: random_depto(rng, cursos, DEPTS[d_id][0]) for d_id in (d_ids or sorted(DEPTS))}
+
+
+# Entrega una copia de depto con added cursos nuevos, deleted cursos eliminados y modified cursos con alguna
+# sección cambiada (cupos, profesores u horario), elegidos al azar.
+def mutate(rng, depto, added=0, deleted=0, modified=0, prefix="XX"):
+    result = Departamento(depto)
+    curso_ids = sorted(result)
+    for c_id in rng.sample(curso_ids, min(deleted, len(curso_ids))):
+        del result[c_id]
+    remaining = sorted(result)
+    for c_id in rng.sample(remaining, min(modified, len(remaining))):
+        curso = result[c_id]
+        secciones = dict(curso.secciones)
+        s_id = rng.choice(sorted(secciones))
+        seccion = secciones[s_id]
+        field = rng.choice(["cupos", "profesores", "horarios"])
+        if field == "cupos":
+            secciones[s_id] = Seccion(seccion.profesores, str(rng.randint(121, 200)), seccion.horarios)
+        elif field == "profesores":
+            secciones[s_id] = Seccion(seccion.profesores + ("Nuevo {}".format(rng.choice(APELLIDOS)),),
+                                      seccion.cupos, seccion.horarios)
+        else:
+            secciones[s_id] = Seccion(seccion.profesores, seccion.cupos, random_horario(rng))
+        result[c_id] = Curso(curso.nombre, secciones)
+    start = len(curso_ids)
+    for i in range(start, start + added):
+        result["{}{:04}".format(prefix, i)] = random_curso(rng, i)
+    return result
+
+
+def _horario_html(horario):
+    lines = []
+    if horario.catedra:
+        lines.append("Cátedra: " + ", ".join(str(x) for x in horario.catedra))
+    if horario.auxiliar:
+        lines.append("Auxiliar: " + ", ".join(str(x) for x in horario.auxiliar))
+    if horario.control:
+        control = "Control: " + ", ".join(str(x) for x in horario.control)
+        if horario.semanas:
+            control += ", Semana: " + ", ".join(str(x) for x in horario.semanas)
+        lines.append(control)
+    return "<br/>\n".join(escape(x) for x in lines)
+
+
+def depto_to_html(depto):
+    parts = ["<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>Catálogo de Cursos</title></head>\n"
+             "<body><div id=\"body\">\n"]
+    for c_id, curso in depto.items():
+        parts.append("<div class=\"ramo\">\n<h2>{} {}</h2>\n<table class=\"secciones\">\n"
+                     "<thead><tr><th>Profesores</th><th>Cupos</th><th>Ocupados</th><th>Horario</th></tr></thead>\n"
+                     "<tbody>\n".format(escape(c_id), escape(curso.nombre)))
+        for s_id, seccion in curso.secciones.items():
+            profes = "".join("<li><h1>{}</h1></li>".format(escape(x)) for x in seccion.profesores)
+            parts.append("<tr id=\"{}-{}\">\n<td><ul class=\"profes\">{}</ul></td>\n<td>{}</td>\n<td>0</td>\n"
+                         "<td>\n{}\n</td>\n</tr>\n".format(escape(c_id), escape(s_id), profes, seccion.cupos,
+                                                          _horario_html(seccion.horarios)))
+        parts.append("</tbody>\n</table>\n</div>\n")
+    parts.append("</div></body></html>\n")
+    return "".join(parts)
+
+
+# Entrega {chat_id: chat_data} para count chats con avisos activados, suscritos a algunos deptos y cursos al azar
+# de catalog (un Catalog o {id de depto: Departamento}). digest es la fracción de chats en modo resumen.
+def random_chats(rng, catalog, count, first_id=1, digest=0.0):
+    deptos = sorted(catalog)
+    cursos = [(d_id, c_id) for d_id in deptos for c_id in sorted(catalog[d_id])]
+    chats = {}
+    for chat_id in range(first_id, first_id + count):
+        subscribed_deptos = rng.sample(deptos, 1) if deptos and rng.random() < 0.3 else []
+        subscribed_cursos = rng.sample(cursos, min(rng.randint(1, 5), len(cursos)))
+        chats[chat_id] = {"enable": True, "digest": rng.random() < digest,
+                          "subscribed_deptos": subscribed_deptos,
+                          "subscribed_cursos": subscribed_cursos}
+    return chats
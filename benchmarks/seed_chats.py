@@ -0,0 +1,43 @@
+# Agrega chats simulados a la base de datos del bot, suscritos al catálogo sintético de fake_server.py.
+#
+# Uso (con el bot detenido, desde la carpeta del bot):
+#   python benchmarks/seed_chats.py 10000
+#   python benchmarks/seed_chats.py 10000 --seed 3 --cursos 100 --digest 0.2
+#
+# --seed y --cursos deben ser los mismos con que se inicia fake_server.py, para que los chats estén suscritos a
+# cursos que existen. Los chats se crean desde --first-id en adelante y reemplazan a los que tengan esos ids.
+import argparse
+import pickle
+import random
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from config.persistence import SQLitePersistence  # noqa: E402
+from fixtures import random_catalog, random_chats  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("count", type=int)
+    parser.add_argument("--db", default=path.relpath("db.sqlite"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cursos", type=int, default=60, help="cursos por depto")
+    parser.add_argument("--first-id", type=int, default=1000000)
+    parser.add_argument("--digest", type=float, default=0.0, help="fracción de chats en modo resumen")
+    args = parser.parse_args()
+
+    catalog = random_catalog(random.Random(args.seed), args.cursos)
+    chats = random_chats(random.Random(args.seed), catalog, args.count, args.first_id, args.digest)
+    persistence = SQLitePersistence(args.db)
+    # Una sola transacción: update_chat_data escribe cada chat por separado
+    with persistence.lock, persistence.conn:
+        persistence.conn.executemany("INSERT OR REPLACE INTO chat_data (chat_id, data) VALUES (?, ?)",
+                                     [(chat_id, pickle.dumps(chat_data)) for chat_id, chat_data in chats.items()])
+    print("Seeded {} chats ({}..{}) in {}".format(len(chats), args.first_id, args.first_id + len(chats) - 1, args.db))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,29 +1,48 @@
 import asyncio
+import hashlib
 import json
-import ssl
+import marshal
+import queue
 import threading
+import time
 from datetime import datetime
+from html import escape
 from os import path
 
 import aiohttp
-import requests
 from bs4 import BeautifulSoup
-from telegram.error import Unauthorized, BadRequest
 from telegram.ext import CommandHandler, Filters
 
 import data
+import metrics
+from async_bot import AsyncBot, API_URL
 from commands import start, stop, subscribe_depto, subscribe_curso, unsubscribe_depto, unsubscribe_curso, deptos, \
-    subscriptions, force_check, get_log, get_chats_data, force_notification, notification, force_check_results, \
-    enable_check_results, enable_check_changes, admin_help, changes_check_interval, \
-    results_check_interval
-from config.auth import admin_ids
+    subscriptions, history, digest, force_check, get_log, get_chats_data, get_catalog, force_notification, \
+    notification, force_check_results, enable_check_results, enable_check_changes, admin_help, changes_check_interval, \
+    results_check_interval, show_metrics, profile_check
+from config.auth import admin_ids, token
 from config.logger import logger
-from constants import DEPTS, YEAR, SEMESTER
+from constants import DEPTS, YEAR, SEMESTER, UCAMPUS_URL, UCURSOS_URL
 from data import updater, dp, jq
-from utils import full_strip, save_config, try_msg, horarios_to_string, parse_horario, notify_thread, AllDeletedException
+from diff import fingerprint_depto, diff_depto
+from fetcher import Fetcher, FetchError
+from history import HistoryStore
+from model import Catalog
+from notifier import Notifier, PRIORITY_HIGH, PRIORITY_LOW
+from outbox import Outbox
+from parsers import parse_depto_async, shutdown_pool
+from render import ChangeRenderer, coalesce
+from scheduler import PollScheduler
+from snapshot import get_snapshot_store
+from profiling import CheckProfiler, hotspots
+from utils import save_config, try_msg, send_long_message, send_generated_file, AllDeletedException
 
+results_lock = threading.Lock()
 
-# Ejemplo de estructura de data:
+MESSAGE_PARAMS = {"parse_mode": "HTML", "disable_web_page_preview": True}
+
+
+# Ejemplo de estructura de data (formato JSON; en memoria se usan las clases de model.py):
 # data = {"5": {"CC3001": {nombre: "Algoritmos y Estructuras de Datos",
 #                          secciones: {"1": {profesor: ["Jérémy Barbay"],
 #                                            cupos: "90",
@@ -52,159 +71,216 @@ from utils import full_strip, save_config, try_msg, horarios_to_string, parse_ho
 #
 
 
-async def fetch(session, url):
-    async with session.get(url, ssl=ssl.SSLContext()) as response:
-        return await response.text()
-
-
-async def fetch_all(urls, loop):
-    async with aiohttp.ClientSession(loop=loop) as session:
-        results = await asyncio.gather(*[fetch(session, url) for url in urls], return_exceptions=True)
-        return results
-
-
+async def fetch(url, dept_id):
+    # Sólo se hacen consultas condicionales si se tiene la información parseada de la última respuesta
+    cached = data.fetch_cache.get(dept_id, {}) if dept_id in data.current_data else {}
+    headers = {}
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+    with metrics.FETCH_SECONDS.time(depto=dept_id):
+        response = await data.fetcher.get(url, headers=headers)
+    if response.status == 304:
+        metrics.FETCH_RESULTS.inc(result="not_modified")
+        return None, cached
+    if response.status >= 400:
+        raise FetchError("GET {} returned HTTP {}".format(url, response.status))
+    cache_entry = {"etag": response.headers.get("ETag"),
+                   "last_modified": response.headers.get("Last-Modified"),
+                   "hash": hashlib.sha1(response.body).hexdigest()}
+    if cached and cache_entry["hash"] == cached.get("hash"):
+        metrics.FETCH_RESULTS.inc(result="unchanged")
+        return None, cache_entry
+    metrics.FETCH_RESULTS.inc(result="changed")
+    return response.body.decode(response.encoding), cache_entry
+
+
+async def scrape_depto(dept_id, parser_name, workers):
+    url = "{}/m/fcfm_catalogo/?semestre={}{}&depto={}".format(data.config.get("ucampus_url", UCAMPUS_URL),
+                                                               YEAR, SEMESTER, dept_id)
+    try:
+        (html, cache_entry) = await fetch(url, dept_id)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Couldn't fetch depto %s (%s: %s). Skipping it on this check.", dept_id, type(e).__name__, e)
+        metrics.FETCH_RESULTS.inc(result="failed")
+        return None
+    if html is None:
+        return dept_id, None, cache_entry
+    parsed = await parse_depto_async(parser_name, html, workers)
+    return dept_id, parsed, cache_entry
+
+
+async def scrape_all(on_depto_ready, deptos):
+    parser_name = data.config.get("catalog_parser", "soup")
+    workers = data.config.get("parse_workers", 1)
+    tasks = [asyncio.ensure_future(scrape_depto(dept_id, parser_name, workers)) for dept_id in deptos]
+    try:
+        # Cada depto se entrega apenas termina de descargarse y parsearse, sin esperar a los más lentos
+        for next_depto in asyncio.as_completed(tasks):
+            depto = await next_depto
+            if depto is not None:
+                on_depto_ready(depto)
+    finally:
+        for task in tasks:
+            task.cancel()
+        on_depto_ready(None)
+
+
+# Guarda sólo los deptos que cambiaron desde el último guardado
 def save_catalog():
-    with open(path.relpath('excluded/catalogdata-{}-{}.json'.format(YEAR, SEMESTER)), "w") as datajsonfile:
-        json.dump(data.current_data, datajsonfile, indent=4)
-
-
-def scrape_catalog():
-    logger.info("Scraping catalog...")
-    result = {}
-    cursos_cnt = 0
-    secciones_cnt = 0
-
-    urls = []
-    for dept_id in DEPTS:
-        urls.append("https://ucampus.uchile.cl/m/fcfm_catalogo/?semestre={}{}&depto={}".format(YEAR, SEMESTER, dept_id))
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    responses = loop.run_until_complete(fetch_all(urls, loop))
-
-    i = 0
-    for dept_id in DEPTS:
-        response = responses[i]
-        i = i + 1
-        dept_data = {}
-        soup = BeautifulSoup(response, 'html.parser')
-
-        for curso_tag in soup.find_all("div", class_="ramo"):
-            cursos_cnt += 1
-            curso_str = full_strip(curso_tag.find("h2").contents[0]).split(" ", 1)
-            curso_id = curso_str[0]
-            curso_nombre = curso_str[1]
-            curso_secciones = {}
-            for seccion_tag in curso_tag.find("tbody").find_all("tr"):
-                secciones_cnt += 1
-                seccion_data = seccion_tag.find_all("td")
-                seccion_id = seccion_tag["id"].split("-")[1]
-                seccion_profesores = []
-                for tag in seccion_data[0].find("ul", class_="profes").find_all("h1"):
-                    seccion_profesores.append(full_strip(tag.text))
-                seccion_cupos = full_strip(seccion_data[1].text)
-                seccion_horarios = parse_horario(seccion_data[3].contents)
-                seccion_dict = {"profesores": seccion_profesores,
-                                "cupos": seccion_cupos,
-                                "horarios": seccion_horarios}
-                curso_secciones[seccion_id] = seccion_dict
-
-            dept_data[curso_id] = {"nombre": curso_nombre, "secciones": curso_secciones}
-
-        result[dept_id] = dept_data
-
-    if len(data.current_data) > 0 and cursos_cnt == 0:
+    if data.unsaved_deptos:
+        with metrics.PERSISTENCE_SECONDS.time(store="catalog"):
+            data.snapshot_store.save(data.current_data, sorted(data.unsaved_deptos))
+        data.unsaved_deptos.clear()
+
+
+def load_catalog():
+    if not data.snapshot_store.exists():
+        legacy_store = get_snapshot_store("json", YEAR, SEMESTER)
+        if legacy_store.exists():
+            logger.info("Loading catalog from legacy JSON file %s.", legacy_store.filename)
+            catalog = legacy_store.load()
+            data.unsaved_deptos.update(catalog)
+            return catalog
+    return data.snapshot_store.load()
+
+
+# Consulta los deptos indicados (por defecto, todos). Los demás se entregan como están en current_data, sin
+# llamar a on_depto.
+def scrape_catalog(on_depto=None, deptos=None):
+    if deptos is None:
+        deptos = list(DEPTS)
+        logger.info("Scraping catalog...")
+    else:
+        logger.info("Scraping %s deptos: %s", len(deptos), deptos)
+    result = {d_id: dept_data for d_id, dept_data in data.current_data.items() if d_id not in deptos}
+    data.new_fetch_cache = {}
+    data.new_fingerprints = {}
+
+    def depto_ready(dept_id, parsed, cache_entry):
+        data.new_fetch_cache[dept_id] = cache_entry
+        if parsed is None:
+            # La página no cambió desde la última consulta, se reutiliza lo ya parseado
+            result[dept_id] = data.current_data[dept_id]
+            if dept_id in data.current_fingerprints:
+                data.new_fingerprints[dept_id] = data.current_fingerprints[dept_id]
+        else:
+            (result[dept_id], data.new_fingerprints[dept_id]) = parsed
+        if on_depto:
+            on_depto(dept_id, result[dept_id])
+
+    # Las descargas corren en el loop del fetcher; los deptos listos se procesan en este thread
+    ready = queue.Queue()
+    future = data.fetcher.submit(scrape_all(ready.put, deptos))
+    try:
+        depto = ready.get()
+        while depto is not None:
+            depto_ready(*depto)
+            depto = ready.get()
+    except Exception:
+        future.cancel()
+        raise
+    future.result()
+
+    result = Catalog((dept_id, result[dept_id]) for dept_id in DEPTS if dept_id in result)
+    cursos_cnt = sum(len(dept_data) for dept_data in result.values())
+    secciones_cnt = sum(len(c.secciones) for dept_data in result.values() for c in dept_data.values())
+
+    fetched_cnt = len(data.new_fetch_cache)
+    if fetched_cnt == 0:
+        # Sin ningún depto descargado no se sabe nada del catálogo (p. ej. U-Campus o la red están caídos): no es
+        # que se hayan borrado los cursos
+        logger.error("Couldn't fetch any of the %s deptos. Keeping old information.", len(deptos))
+    elif len(data.current_data) > 0 and cursos_cnt == 0:
         raise AllDeletedException()
 
-    logger.info("Finished scraping, found %s cursos with %s secciones", cursos_cnt, secciones_cnt)
+    logger.info("Finished scraping %s of %s deptos, found %s cursos with %s secciones",
+                fetched_cnt, len(deptos), cursos_cnt, secciones_cnt)
     return result
 
 
-def check_catalog(context):
+# Corre check(context), bajo el profiler si un admin lo pidió con /profile_check, y en ese caso le envía las
+# funciones más lentas y el archivo del perfil (se abre con pstats, snakeviz, etc.)
+def run_check(kind, check, context):
+    admin_id = data.profile_requests.pop(kind, None)
+    if admin_id is None:
+        check(context)
+        return
+    logger.info("Profiling %s check for admin %s.", kind, admin_id)
+    profiler = CheckProfiler(data.fetcher.loop)
     try:
-        data.new_data = scrape_catalog()
+        profiler.start()
+    except ValueError as e:
+        logger.error("Couldn't profile %s check (%s). Running it without profiling.", kind, e)
+        try_msg(context.bot, chat_id=admin_id, text="Couldn't profile the {} check: {}".format(kind, e))
+        check(context)
+        return
+    try:
+        check(context)
+    finally:
+        profiler.stop()
+    stats = profiler.stats()
+    try:
+        send_generated_file(context.bot, admin_id,
+                            "catalogobot_profile_{}_{}.prof".format(kind, datetime.now().strftime("%d%b%Y-%H%M%S")),
+                            lambda temp_file: marshal.dump(stats.stats, temp_file), binary=True)
+        send_long_message(context.bot, chat_id=admin_id,
+                          text="<pre>{}</pre>".format(escape(hotspots(stats), quote=False)), parse_mode="HTML")
+    except Exception:
+        logger.exception("Couldn't send %s check profile to admin %s:", kind, admin_id)
 
-        all_changes = {}
 
-        for d_id in DEPTS:
-            old_cursos_data = data.current_data.get(d_id, {})
-            new_cursos_data = data.new_data.get(d_id, {})
-            if len(old_cursos_data) >= 3 and len(new_cursos_data) == 0:
-                data.new_data.update({d_id: old_cursos_data})
-                logger.exception(
-                    f'All cursos in ({d_id}) {DEPTS[d_id][1]} were deleted. Skipping this depto and keeping old information.')
-                try_msg(context.bot,
-                        chat_id=admin_ids[0],
-                        text=f'Todos los cursos de {DEPTS[d_id][1]} fueron borrados. Me saltaré este departamento y mantendré la información anterior.')
-                continue
+# Con adaptive_polling se revisa antes de correr el check si algún depto toca, para que un /profile_check no se
+# gaste en un check vacío
+def check_catalog(context):
+    deptos = data.scheduler.take_due() if data.scheduler is not None else None
+    if deptos == []:
+        return  # Ningún depto toca todavía
+    run_check("catalog", lambda context: _check_catalog(context, deptos), context)
 
-            old_cursos = old_cursos_data.keys()
-            new_cursos = new_cursos_data.keys()
-            ocs = set(old_cursos)
-            ncs = set(new_cursos)
-            added = [x for x in new_cursos if x not in ocs]
-            deleted = [x for x in old_cursos if x not in ncs]
-            inter = [x for x in old_cursos if x in ncs]
-            modified = {}
-            d_data = data.current_data[d_id]
-            d_new_data = data.new_data[d_id]
-            for c_id in inter:
-                mods = {}
-                if d_data[c_id]["nombre"] != d_new_data[c_id]["nombre"]:
-                    mods["nombre"] = [d_data[c_id]["nombre"], d_new_data[c_id]["nombre"]]
-                old_secciones = set(d_data[c_id]["secciones"].keys())
-                new_secciones = set(d_new_data[c_id]["secciones"].keys())
-                changes_sec = {}
-                added_sec = new_secciones - old_secciones
-                deleted_sec = old_secciones - new_secciones
-                inter_sec = old_secciones & new_secciones
-                modified_sec = {}
-                for s_id in inter_sec:
-                    mods_sec = {}
-                    s_id = str(s_id)
-                    if d_data[c_id]["secciones"][s_id]["profesores"] \
-                            != d_new_data[c_id]["secciones"][s_id]["profesores"]:
-                        mods_sec["profesores"] = [d_data[c_id]["secciones"][s_id]["profesores"],
-                                                  d_new_data[c_id]["secciones"][s_id]["profesores"]]
-                    if d_data[c_id]["secciones"][s_id]["cupos"] != d_new_data[c_id]["secciones"][s_id]["cupos"]:
-                        mods_sec["cupos"] = [d_data[c_id]["secciones"][s_id]["cupos"],
-                                             d_new_data[c_id]["secciones"][s_id]["cupos"]]
-                    if d_data[c_id]["secciones"][s_id]["horarios"] != d_new_data[c_id]["secciones"][s_id]["horarios"]:
-                        mods_sec["horarios"] = [d_data[c_id]["secciones"][s_id]["horarios"],
-                                                d_new_data[c_id]["secciones"][s_id]["horarios"]]
-                    if len(mods_sec) > 0:
-                        modified_sec[s_id] = mods_sec
-
-                if len(added_sec) > 0:
-                    changes_sec["added"] = added_sec
-                if len(deleted_sec) > 0:
-                    changes_sec["deleted"] = deleted_sec
-                if len(modified_sec) > 0:
-                    changes_sec["modified"] = modified_sec
-
-                if len(changes_sec) > 0:
-                    mods["secciones"] = changes_sec
-
-                if len(mods) > 0:
-                    modified[c_id] = mods
-
-            if added or deleted or modified:
-                all_changes[d_id] = {}
-                if added:
-                    all_changes[d_id]["added"] = added
-                if deleted:
-                    all_changes[d_id]["deleted"] = deleted
-                if modified:
-                    all_changes[d_id]["modified"] = modified
-
-        if len(all_changes) > 0:
-            logger.info("Changes detected on %s", str([x for x in all_changes]))
-            notify_changes(all_changes, context)
+
+def _check_catalog(context, deptos=None):
+    start = time.perf_counter()
+    try:
+        data.new_data = Catalog()
+        empty_deptos = []
+        changed_deptos = []
+
+        polled_deptos = []
+        data.notice_renderer = ChangeRenderer()
+        data.pending_notices = {}
+        data.pending_notice_keys = []
+
+        def on_depto(d_id, dept_data):
+            data.new_data[d_id] = dept_data
+            polled_deptos.append(d_id)
+            if len(dept_data) == 0:
+                # Se revisan al final, una vez descartado que se hayan borrado todos los cursos
+                empty_deptos.append(d_id)
+            elif check_depto(d_id, context):
+                changed_deptos.append(d_id)
+
+        try:
+            scrape_catalog(on_depto, deptos)
+            for d_id in empty_deptos:
+                if check_depto(d_id, context):
+                    changed_deptos.append(d_id)
+        finally:
+            # Los deptos revisados ya quedaron como actuales: sus avisos se envían aunque el check falle
+            send_notices(context)
+        if data.scheduler is not None:
+            for d_id in polled_deptos:
+                data.scheduler.update(d_id, d_id in changed_deptos)
+
+        if len(changed_deptos) > 0:
+            logger.info("Changes detected on %s", str(changed_deptos))
         else:
             logger.info("No changes detected")
-        data.current_data = data.new_data
         data.last_check_time = datetime.now()
 
         save_catalog()
+        metrics.CHECK_SECONDS.observe(time.perf_counter() - start, check="catalog")
 
     except AllDeletedException as e:
         logger.error("All cursos were deleted. Aborting check and keeping old information.")
@@ -218,61 +294,71 @@ def check_catalog(context):
                 text="Ayuda, ocurrió un error y no supe qué hacer uwu.\n{}: {}".format(str(type(e).__name__), str(e)))
 
 
-def notify_changes(all_changes, context):
+# Compara un depto recién scrapeado con la información actual, agrega sus cambios a los avisos del check y lo deja
+# como actual. Se hace depto por depto a medida que llegan; si el check falla más adelante, los avisos de los deptos
+# ya revisados igual se envían (ver _check_catalog).
+def check_depto(d_id, context):
+    old_cursos_data = data.current_data.get(d_id, {})
+    new_cursos_data = data.new_data[d_id]
+    if d_id not in data.current_data:
+        # No hay información anterior con qué comparar (p. ej. la descarga falló en el scraping inicial)
+        logger.info("No previous data for depto %s, storing it without notifying.", d_id)
+    elif len(old_cursos_data) >= 3 and len(new_cursos_data) == 0:
+        logger.exception(
+            f'All cursos in ({d_id}) {DEPTS[d_id][1]} were deleted. Skipping this depto and keeping old information.')
+        try_msg(context.bot,
+                chat_id=admin_ids[0],
+                text=f'Todos los cursos de {DEPTS[d_id][1]} fueron borrados. Me saltaré este departamento y mantendré la información anterior.')
+        return False
+
+    changes = {}
+    if d_id in data.current_data and old_cursos_data is not new_cursos_data:
+        old_fp = data.current_fingerprints.get(d_id) or fingerprint_depto(old_cursos_data)
+        if d_id not in data.new_fingerprints:
+            data.new_fingerprints[d_id] = fingerprint_depto(new_cursos_data)
+        with metrics.DIFF_SECONDS.time():
+            changes = diff_depto(old_cursos_data, new_cursos_data, old_fp, data.new_fingerprints[d_id])
+        if changes:
+            try:
+                data.history.record(d_id, changes, old_cursos_data, new_cursos_data)
+            except Exception as e:
+                logger.exception("Couldn't record changes of depto %s in history: %s", d_id, e)
+            (old_hash, new_hash) = (old_fp["hash"], data.new_fingerprints[d_id]["hash"])
+            data.notice_renderer.add(d_id, changes, old_cursos_data, new_cursos_data)
+            notify_changes({d_id: changes}, context, "{}:{}:{}:{}".format(
+                d_id, old_hash, new_hash, data.outbox.change_seq(d_id, old_hash, new_hash)))
+
+    if changes or d_id not in data.current_data:
+        data.unsaved_deptos.add(d_id)
+    data.current_data[d_id] = new_cursos_data
+    data.fetch_cache[d_id] = data.new_fetch_cache[d_id]
+    if d_id in data.new_fingerprints:
+        data.current_fingerprints[d_id] = data.new_fingerprints[d_id]
+    return len(changes) > 0
+
+
+# Agrega los avisos de all_changes para cada chat suscrito a los del check en curso, que se envían juntos al final
+# con send_notices. A los chats en modo resumen se les guardan para el próximo resumen. key identifica a estos
+# cambios (p. ej. el depto, sus hashes antes y después y el número de detección), para no encolarlos dos veces si
+# se vuelven a detectar. Los deptos de all_changes deben estar en data.notice_renderer.
+def notify_changes(all_changes, context, key):
     chats_data = dp.chat_data
-    changes_dict = {}
-    for d_id in all_changes:
-        changes_str = changes_to_string(all_changes[d_id], d_id)
-        changes_dict[d_id] = changes_str
+    renderer = data.notice_renderer
 
+    digest_blocks = []
     # for chat_id in admin_ids:  # DEBUG, send only to admin
-    for chat_id in chats_data:
-        if chats_data[chat_id].setdefault("enable", False):
+    for chat_id, (dept_matches, curso_matches) in data.subscriptions.matches(all_changes).items():
+        if chats_data[chat_id].get("enable", False):
             try:
-                subscribed_deptos = chats_data[chat_id].setdefault("subscribed_deptos", [])
-                subscribed_cursos = chats_data[chat_id].setdefault("subscribed_cursos", [])
-                dept_matches = [x for x in subscribed_deptos if x in all_changes]
-                curso_matches = [x for x in subscribed_cursos if (x[0] in all_changes
-                                                                  and (x[1] in all_changes[x[0]].get("added", []) or
-                                                                       x[1] in all_changes[x[0]].get("deleted", []) or
-                                                                       x[1] in all_changes[x[0]].get("modified", {})))]
-
-                if dept_matches or curso_matches:
-                    deptos_messages = []
-                    for d_id in dept_matches:
-                        deptos_messages.append("<b>Cambios en {}</b>"
-                                               "\n{}\n"
-                                               "<a href='https://ucampus.uchile.cl/m/fcfm_catalogo/"
-                                               "?semestre={}{}&depto={}'>"
-                                               "\U0001F50D Ver catálogo</a>"
-                                               .format(DEPTS[d_id][1], changes_dict[d_id], YEAR, SEMESTER, d_id))
-                    cursos_messages = []
-                    for d_c_id in curso_matches:
-                        d_id = d_c_id[0]
-                        c_id = d_c_id[1]
-                        change_type_str = ""
-                        curso_changes_str = ""
-                        if c_id in all_changes[d_id].get("added", []):
-                            change_type_str = "Curso añadido:"
-                            curso_changes_str = added_curso_string(c_id, d_id)
-                        elif c_id in all_changes[d_id].get("deleted", []):
-                            change_type_str = "Curso eliminado:"
-                            curso_changes_str = deleted_curso_string(c_id, d_id)
-                        elif c_id in all_changes[d_id].get("modified", {}):
-                            change_type_str = "Curso modificado:"
-                            curso_changes_str = modified_curso_string(c_id, d_id, all_changes[d_id]["modified"][c_id])
-                            cursos_messages.append("<b>{}</b>"
-                                                   "\n{}\n"
-                                                   "<a href='https://ucampus.uchile.cl/m/fcfm_catalogo/"
-                                                   "?semestre={}{}&depto={}'>"
-                                                   "\U0001F50D Ver catálogo</a>"
-                                                   .format(change_type_str, curso_changes_str, YEAR, SEMESTER, d_id))
-
-                    t = threading.Thread(target=notify_thread,
-                                         args=(context, chat_id, deptos_messages, cursos_messages))
-                    t.start()
-            except (Unauthorized, BadRequest):
-                continue
+                # Los cursos de un depto suscrito ya van en el aviso del depto
+                blocks = [(d_id, None) for d_id in dept_matches] + \
+                         [(d_id, c_id) for (d_id, c_id) in curso_matches if d_id not in dept_matches]
+                if chats_data[chat_id].get("digest", False):
+                    for (d_id, c_id) in blocks:
+                        digest_blocks.append(("changes:{}:{}:{}".format(key, chat_id, c_id or ""), chat_id,
+                                              renderer.block(d_id, c_id)))
+                    continue
+                data.pending_notices.setdefault(chat_id, []).extend(blocks)
             except Exception as e:
                 logger.exception("Uncaught exception occurred when notifying chat:")
                 logger.error("Notification process will continue regardless.")
@@ -282,111 +368,92 @@ def notify_changes(all_changes, context):
                         .format(str(type(e).__name__), str(e)))
                 continue
 
+    data.pending_notice_keys.append(key)
+    if digest_blocks:
+        data.outbox.add_to_digest(digest_blocks)
 
-def added_curso_string(curso_id, depto_id):
-    result = ""
-    curso = data.new_data[depto_id][curso_id]
-    result += "\U0001F4D7 <b>{} {}</b>\n".format(curso_id, curso["nombre"])
-    for seccion_id in curso["secciones"]:
-        seccion = curso["secciones"][seccion_id]
-        profs = ", ".join(seccion["profesores"])
-        result += "    S{} - {} - {} cupos\n".format(seccion_id, profs, seccion["cupos"])
-        result += horarios_to_string(seccion["horarios"], 8)
-    return result
-
-
-def deleted_curso_string(curso_id, depto_id):
-    result = ""
-    curso = data.current_data[depto_id][curso_id]
-    result += "\U0001F4D9 <b>{} {}</b>\n".format(curso_id, curso["nombre"])
-    return result
-
-
-def modified_curso_string(curso_id, depto_id, curso_mods):
-    result = ""
-    if "nombre" in curso_mods:
-        result += "\U0001F4D8 <b>{}</b> <i>{}</i>\n<i>Renombrado:</i> <b>{}</b>\n" \
-            .format(curso_id, curso_mods["nombre"][0], curso_mods["nombre"][1])
-    else:
-        result += "\U0001F4D8 <b>{} {}</b>\n".format(curso_id, data.new_data[depto_id][curso_id]["nombre"])
-    if "secciones" in curso_mods:
-        if "added" in curso_mods["secciones"]:
-            result += "    <i>Secciones añadidas:</i>\n"
-            for seccion_id in curso_mods["secciones"]["added"]:
-                seccion = data.new_data[depto_id][curso_id]["secciones"][seccion_id]
-                profs = ", ".join(seccion["profesores"])
-                result += "    \U00002795 Secc. {} - {} - {} cupos\n".format(seccion_id, profs,
-                                                                             seccion["cupos"])
-                result += horarios_to_string(seccion["horarios"], 8)
-        if "deleted" in curso_mods["secciones"]:
-            result += "    <i>Secciones eliminadas:</i>\n"
-            for seccion_id in curso_mods["secciones"]["deleted"]:
-                seccion = data.current_data[depto_id][curso_id]["secciones"][seccion_id]
-                profs = ", ".join(seccion["profesores"])
-                result += "    \U00002796 Secc. {} - {}\n".format(seccion_id, profs)
-        if "modified" in curso_mods["secciones"]:
-            result += "    <i>Secciones modificadas:</i>\n"
-            for seccion_id in curso_mods["secciones"]["modified"]:
-                seccion_mods = curso_mods["secciones"]["modified"][seccion_id]
-                if "profesores" in seccion_mods:
-                    result += "    \U00003030 <b>Sección {}</b>\n".format(seccion_id)
-                    result += "        Cambia profesor\n".format(seccion_id)
-                    result += "        \U00002013 de: <i>{}</i>\n".format(
-                        ", ".join(seccion_mods["profesores"][0]))
-                    result += "        \U00002013 a: <b>{}</b>\n".format(
-                        ", ".join(seccion_mods["profesores"][1]))
-                else:
-                    profs = ", ".join(data.new_data[depto_id][curso_id]["secciones"][seccion_id]["profesores"])
-                    result += "    \U00003030 <b>Sección {}</b> - {}\n".format(seccion_id, profs)
-                if "cupos" in seccion_mods:
-                    result += "        Cambia cupos\n".format(seccion_id)
-                    result += "        \U00002013 de: <i>{}</i>\n".format(seccion_mods["cupos"][0])
-                    result += "        \U00002013 a: <b>{}</b>\n".format(seccion_mods["cupos"][1])
-                if "horarios" in seccion_mods:
-                    result += "        Cambia horario\n".format(seccion_id)
-                    result += "        \U00002013 de:\n{}".format(
-                        horarios_to_string(seccion_mods["horarios"][0], 12))
-                    result += "        \U00002013 a:\n{}".format(
-                        horarios_to_string(seccion_mods["horarios"][1], 12))
-    return result
 
+# Encola en el outbox los avisos del check en curso y los envía: a cada chat, los de todos sus deptos y cursos
+# juntos en la menor cantidad de mensajes (ver render.coalesce).
+def send_notices(context):
+    if not data.pending_notices:
+        return
+    key = hashlib.sha1("|".join(data.pending_notice_keys).encode("utf-8")).hexdigest()
+    outbox_messages = []
+    start = time.perf_counter()
+    for chat_id, blocks in data.pending_notices.items():
+        try:
+            for (i, message) in enumerate(data.notice_renderer.messages(blocks)):
+                outbox_messages.append(("changes:{}:{}:{}".format(key, chat_id, i), chat_id, message,
+                                        MESSAGE_PARAMS))
+        except Exception as e:
+            logger.exception("Uncaught exception occurred when notifying chat:")
+            logger.error("Notification process will continue regardless.")
+            try_msg(context.bot,
+                    chat_id=admin_ids[0],
+                    text="Ayuda, ocurrió un error al notificar y no supe qué hacer uwu.\n{}: {}"
+                    .format(str(type(e).__name__), str(e)))
+    metrics.RENDER_SECONDS.observe(time.perf_counter() - start)
+    data.pending_notices = {}
+
+    data.notifier.send("changes", data.outbox.enqueue(outbox_messages))
+
+
+# Envía a los chats en modo resumen los avisos acumulados desde el último resumen
+def send_digests(context):
+    messages = data.outbox.flush_digests(coalesce, MESSAGE_PARAMS)
+    if messages:
+        logger.info("Sending %s digest messages.", len(messages))
+        data.notifier.send("digest", messages, PRIORITY_LOW)
+
+
+def job_results(context):
+    # Corre en un thread del dispatcher: el JobQueue ejecuta sus jobs en serie, y así un check_catalog lento no
+    # retrasa este check (ni viceversa).
+    dp.run_async(check_results, context)
 
-def changes_to_string(changes, depto_id):
-    added = changes.get("added", [])
-    deleted = changes.get("deleted", [])
-    modified = changes.get("modified", [])
-    changes_str = ""
-    if len(added) > 0:
-        changes_str += "\n<i>Cursos añadidos:</i>\n"
-        for curso_id in added:
-            changes_str += added_curso_string(curso_id, depto_id)
-    if len(deleted) > 0:
-        changes_str += "\n<i>Cursos eliminados:</i>\n"
-        for curso_id in deleted:
-            changes_str += deleted_curso_string(curso_id, depto_id)
-    if len(modified) > 0:
-        changes_str += "\n<i>Cursos modificados:</i>\n"
-        for curso_id in modified:
-            changes_str += modified_curso_string(curso_id, depto_id, modified[curso_id])
 
-    return changes_str
+def check_results(context):
+    if not results_lock.acquire(blocking=False):
+        logger.info("Previous results check is still running. Skipping this one.")
+        return
+    try:
+        with metrics.CHECK_SECONDS.time(check="results"):
+            run_check("results", fetch_results, context)
+    finally:
+        results_lock.release()
 
 
-def check_results(context):
+def fetch_results(context):
     logger.info("Checking for results...")
 
-    response = requests.get("https://www.u-cursos.cl/ingenieria/2/novedades_institucion/")
-    soup = BeautifulSoup(response.content, 'html.parser')
+    headers = {}
+    if data.results_cache.get("etag"):
+        headers["If-None-Match"] = data.results_cache["etag"]
+    if data.results_cache.get("last_modified"):
+        headers["If-Modified-Since"] = data.results_cache["last_modified"]
+    try:
+        url = "{}/ingenieria/2/novedades_institucion/".format(data.config.get("ucursos_url", UCURSOS_URL))
+        response = data.fetcher.run(data.fetcher.get(url, headers=headers))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Couldn't fetch novedades (%s: %s).", type(e).__name__, e)
+        return
+    if response.status == 304:
+        return
+    if response.status >= 400:
+        logger.error("Novedades returned HTTP %s.", response.status)
+        return
+    # Se guarda recién al terminar: si algo falla antes, la próxima consulta vuelve a traer la página completa
+    results_cache = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+    soup = BeautifulSoup(response.body, 'html.parser')
 
     novedad = soup.find("div", class_="objeto")
 
     novedad_id = novedad["data-id"]
     if novedad_id == data.config["last_novedad_id"]:
+        data.results_cache = results_cache
         return
 
-    data.config["last_novedad_id"] = novedad_id
-    save_config()
-    
     title = novedad.find("h1").find("a").contents[0]
     ltitle = title.lower()
     if "resultado" in ltitle and (
@@ -404,14 +471,16 @@ def check_results(context):
                    "\U0001F50D Ver resultados IA</a>\n"
                    "<a href='https://www.u-cursos.cl/ingenieria/2/novedades_institucion'>"
                    "\U0001F381 Ver Novedades</a>".format(title))
-        for chat_id in chats_data:
-            if chats_data[chat_id].get("enable", False):
-                try_msg(context.bot,
-                        chat_id=chat_id,
-                        text=message,
-                        parse_mode="HTML",
-                        disable_web_page_preview=True,
-                        )
+        data.notifier.send("novedad",
+                           data.outbox.enqueue([("novedad:{}:{}".format(novedad_id, chat_id), chat_id, message,
+                                                 MESSAGE_PARAMS)
+                                                for chat_id in list(chats_data)
+                                                if chats_data[chat_id].get("enable", False)]),
+                           PRIORITY_HIGH)
+
+    data.config["last_novedad_id"] = novedad_id
+    save_config()
+    data.results_cache = results_cache
 
 
 def main():
@@ -423,29 +492,68 @@ def main():
         logger.error("Bot config was not found. Can't initialize.")
         return
 
+    # El Updater se crea al importar data.py, antes de leer la configuración
+    api_url = data.config.get("telegram_api_url", API_URL)
+    updater.bot.base_url = api_url + token
+
+    data.fetcher = Fetcher(limit_per_host=data.config.get("http_limit_per_host", 6),
+                           timeout=data.config.get("http_timeout", 20),
+                           retries=data.config.get("http_retries", 3),
+                           backoff=data.config.get("http_backoff", 1.0))
+
+    if data.config.get("metrics_port"):
+        metrics.serve(data.config["metrics_port"])
+
+    data.outbox = Outbox(path.relpath('excluded/outbox.sqlite'))
+    data.outbox.purge()
+    data.notifier = Notifier(AsyncBot(token, data.fetcher, base_url=api_url), data.fetcher.loop,
+                             workers=data.config.get("notification_workers", 8), outbox=data.outbox)
+    pending_messages = data.outbox.pending()
+    if pending_messages:
+        logger.info("Resuming %s pending messages from the outbox.", len(pending_messages))
+        data.notifier.send("resume", pending_messages)
+
     try_msg(updater.bot,
             chat_id=admin_ids[0],
             text=f'Bot iniciado. Config:\n<pre>{json.dumps(data.config, indent=2)}</pre>',
             parse_mode="HTML")
 
+    data.history = HistoryStore(path.relpath('excluded/history-{}-{}.sqlite'.format(YEAR, SEMESTER)))
+    data.snapshot_store = get_snapshot_store(data.config.get("snapshot_format", "binary"), YEAR, SEMESTER)
     try:
-        with open(path.relpath('excluded/catalogdata-{}-{}.json'.format(YEAR, SEMESTER)), "r") as datajsonfile:
-            data.current_data = json.load(datajsonfile)
+        data.current_data = load_catalog()
         logger.info("Data loaded from local, initial check for changes will be made.")
         check_first = True
     except OSError:
         logger.info("No local data was found, initial scraping will be made without checking for changes.")
         check_first = False
         data.current_data = scrape_catalog()
+        data.fetch_cache = data.new_fetch_cache
+        data.current_fingerprints = data.new_fingerprints
+        data.unsaved_deptos.update(data.current_data)
         save_catalog()
 
-    data.job_check_changes = jq.run_repeating(check_catalog, interval=data.config["changes_check_interval"],
+    data.subscriptions.rebuild(dp.chat_data)
+
+    check_interval = data.config["changes_check_interval"]
+    if data.config.get("adaptive_polling", False):
+        # El check corre cada poll_min_interval segundos, pero sólo consulta los deptos que toca (ver scheduler.py);
+        # changes_check_interval pasa a ser el intervalo máximo de cada depto. Por defecto no se consulta a U-Campus
+        # más seguido que sin adaptive_polling (todos los deptos cada changes_check_interval)
+        data.scheduler = PollScheduler(list(DEPTS),
+                                       min_interval=data.config.get("poll_min_interval", 15),
+                                       max_interval=check_interval,
+                                       budget=data.config.get("poll_budget", len(DEPTS) * 60 / check_interval),
+                                       backoff=data.config.get("poll_backoff", 1.5))
+        check_interval = data.scheduler.min_interval
+    data.job_check_changes = jq.run_repeating(check_catalog, interval=check_interval,
                                               first=(1 if check_first else None),
                                               name="job_check")
     data.job_check_changes.enabled = data.config["is_checking_changes"]
-    data.job_check_results = jq.run_repeating(check_results, interval=data.config["results_check_interval"],
+    data.job_check_results = jq.run_repeating(job_results, interval=data.config["results_check_interval"],
                                               name="job_results")
     data.job_check_results.enabled = data.config["is_checking_results"]
+    jq.run_repeating(send_digests, interval=data.config.get("digest_window", 3600), name="job_digest")
 
     dp.add_handler(CommandHandler('start', start))
     dp.add_handler(CommandHandler('stop', stop))
@@ -455,10 +563,15 @@ def main():
     dp.add_handler(CommandHandler('desuscribir_curso', unsubscribe_curso))
     dp.add_handler(CommandHandler('deptos', deptos))
     dp.add_handler(CommandHandler('suscripciones', subscriptions))
+    dp.add_handler(CommandHandler('historial', history))
+    dp.add_handler(CommandHandler('resumen', digest))
     # Admin commands
     dp.add_handler(CommandHandler('force_check', force_check, filters=Filters.user(admin_ids)))
+    dp.add_handler(CommandHandler('profile_check', profile_check, filters=Filters.user(admin_ids)))
     dp.add_handler(CommandHandler('get_log', get_log, filters=Filters.user(admin_ids)))
     dp.add_handler(CommandHandler('get_chats_data', get_chats_data, filters=Filters.user(admin_ids)))
+    dp.add_handler(CommandHandler('get_catalog', get_catalog, filters=Filters.user(admin_ids)))
+    dp.add_handler(CommandHandler('metrics', show_metrics, filters=Filters.user(admin_ids)))
     dp.add_handler(CommandHandler('notification', notification, filters=Filters.user(admin_ids)))
     dp.add_handler(CommandHandler('force_notification', force_notification, filters=Filters.user(admin_ids)))
     dp.add_handler(CommandHandler('force_check_results', force_check_results, filters=Filters.user(admin_ids)))
@@ -470,6 +583,11 @@ def main():
 
     updater.start_polling()
     updater.idle()
+    data.notifier.close()
+    data.fetcher.close()
+    shutdown_pool()
+    data.history.close()
+    data.outbox.close()
 
 
 if __name__ == '__main__':
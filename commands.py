@@ -1,15 +1,22 @@
 import json
 import os
-import pickle
-import tempfile
 from datetime import timedelta, datetime
+from html import escape
 
 import data
+import metrics
 from config.auth import admin_ids
 from config.logger import logger
-from constants import DEPTS
+from constants import DEPTS, YEAR, SEMESTER
 from data import jq, dp
-from utils import save_config, try_msg
+from model import Horario
+from render import horarios_diff_to_string
+from snapshot import export_json
+from utils import save_config, try_msg, send_long_message, send_file, send_generated_file
+
+HISTORY_DEFAULT_DAYS = 7
+HISTORY_MAX_CHANGES = 100
+HISTORY_MAX_DAYS = 365  # El historial es de un solo semestre, no tiene sentido buscar más atrás
 
 
 def start(update, context):
@@ -23,6 +30,7 @@ def start(update, context):
                 )
     else:
         context.chat_data["enable"] = True
+        data.subscriptions.update_chat(update.message.chat_id, context.chat_data)
         try_msg(context.bot,
                 chat_id=update.message.chat_id,
                 text="A partir de ahora avisaré por este chat si detecto algún cambio en el catálogo de cursos."
@@ -33,6 +41,7 @@ def start(update, context):
 def stop(update, context):
     logger.info("[Command /stop]")
     context.chat_data["enable"] = False
+    data.subscriptions.update_chat(update.message.chat_id, context.chat_data)
     try_msg(context.bot,
             chat_id=update.message.chat_id,
             text="Ok, dejaré de avisar cambios en el catálogo por este chat. "
@@ -52,12 +61,13 @@ def subscribe_depto(update, context):
                     context.chat_data["subscribed_deptos"] = []
                 if arg not in context.chat_data["subscribed_deptos"]:
                     context.chat_data["subscribed_deptos"].append(arg)
-                    data.persistence.flush()
                     added.append(arg)
                 else:
                     already.append(arg)
             else:
                 failed.append(arg)
+        if added:
+            data.subscriptions.update_chat(update.message.chat_id, context.chat_data)
         response = ""
         if added:
             response += "\U0001F4A1 Te avisaré sobre los cambios en:\n<i>{}</i>\n\n" \
@@ -95,6 +105,7 @@ def subscribe_curso(update, context):
         added = []
         already = []
         unknown = []
+        unavailable = []
         failed = []
         failed_depto = []
         for arg in context.args:
@@ -110,9 +121,10 @@ def subscribe_curso(update, context):
                     context.chat_data["subscribed_cursos"] = []
                 if (d_arg, c_arg) not in context.chat_data["subscribed_cursos"]:
                     context.chat_data["subscribed_cursos"].append((d_arg, c_arg))
-                    data.persistence.flush()
-                    is_curso_known = c_arg in data.current_data[d_arg]
-                    if is_curso_known:
+                    if d_arg not in data.current_data:
+                        # No se pudo descargar el depto en el scraping inicial
+                        unavailable.append((d_arg, c_arg))
+                    elif c_arg in data.current_data[d_arg]:
                         added.append((d_arg, c_arg))
                     else:
                         unknown.append((d_arg, c_arg))
@@ -120,6 +132,8 @@ def subscribe_curso(update, context):
                     already.append((d_arg, c_arg))
             else:
                 failed_depto.append((d_arg, c_arg))
+        if added or unknown or unavailable:
+            data.subscriptions.update_chat(update.message.chat_id, context.chat_data)
         response = ""
         if added:
             response += "\U0001F4A1 Te avisaré sobre cambios en:\n<i>{}</i>\n\n" \
@@ -128,6 +142,11 @@ def subscribe_curso(update, context):
             response += "\U0001F4A1 Actualmente no tengo registros de:\n<i>{}</i>\n" \
                 .format("\n".join(["- " + (x[1] + " en " + DEPTS[x[0]][1] + " ({})".format(x[0])) for x in unknown]))
             response += "Te avisaré si aparece algún curso con ese código en ese depto.\n\n"
+        if unavailable:
+            response += "\U0001F4A1 El departamento de estos cursos no está disponible por el momento:\n<i>{}</i>\n" \
+                .format("\n".join(["- " + (x[1] + " en " + DEPTS[x[0]][1] + " ({})".format(x[0]))
+                                   for x in unavailable]))
+            response += "Quedaste suscrito, y te avisaré sobre cambios apenas logre consultarlo.\n\n"
         if already:
             response += "\U0001F44D Ya estabas suscrito a:\n<i>{}</i>.\n\n" \
                 .format("\n".join(["- " + (x[1] + " de " + DEPTS[x[0]][1] + " ({})".format(x[0])) for x in already]))
@@ -146,7 +165,7 @@ def subscribe_curso(update, context):
                 parse_mode="HTML",
                 text=response)
 
-        if (added or unknown) and not context.chat_data.get("enable", False):
+        if (added or unknown or unavailable) and not context.chat_data.get("enable", False):
             try_msg(context.bot,
                     chat_id=update.message.chat_id,
                     parse_mode="HTML",
@@ -171,12 +190,13 @@ def unsubscribe_depto(update, context):
             if arg in DEPTS:
                 if arg in context.chat_data["subscribed_deptos"]:
                     context.chat_data["subscribed_deptos"].remove(arg)
-                    data.persistence.flush()
                     deleted.append(arg)
                 else:
                     notsuscribed.append(arg)
             else:
                 failed.append(arg)
+        if deleted:
+            data.subscriptions.update_chat(update.message.chat_id, context.chat_data)
         response = ""
 
         if deleted:
@@ -226,12 +246,13 @@ def unsubscribe_curso(update, context):
                     context.chat_data["subscribed_cursos"] = []
                 if (d_arg, c_arg) in context.chat_data["subscribed_cursos"]:
                     context.chat_data["subscribed_cursos"].remove((d_arg, c_arg))
-                    data.persistence.flush()
                     deleted.append((d_arg, c_arg))
                 else:
                     notsub.append((d_arg, c_arg))
             else:
                 failed_depto.append((d_arg, c_arg))
+        if deleted:
+            data.subscriptions.update_chat(update.message.chat_id, context.chat_data)
         response = ""
         if deleted:
             response += "\U0001F6D1 Dejaré de avisarte sobre cambios en:\n<i>{}</i>\n\n" \
@@ -290,6 +311,10 @@ def subscriptions(update, context):
         .format("Sí \U00002714 (Detener: /stop)" if context.chat_data.get("enable", False)
                              else "No \U0000274C (Activar: /start)")
 
+    if context.chat_data.get("digest", False):
+        result += "<b>Modo resumen:</b> <i>Cada {} minutos (Desactivar: /resumen)</i>\n\n" \
+            .format(data.config.get("digest_window", 3600) // 60)
+
     if sub_deptos_list or sub_cursos_list:
         result += "Actualmente doy los siguientes avisos para este chat:\n\n"
     else:
@@ -313,9 +338,90 @@ def subscriptions(update, context):
             text=result)
 
 
+def digest(update, context):
+    logger.info("[Command /resumen]")
+    context.chat_data["digest"] = not context.chat_data.get("digest", False)
+    if context.chat_data["digest"]:
+        text = "\U0001F4E6 Desde ahora juntaré los cambios y te enviaré un resumen cada {} minutos.\n" \
+               "Para volver a recibir los avisos apenas los detecte, envía /resumen nuevamente." \
+            .format(data.config.get("digest_window", 3600) // 60)
+    else:
+        text = "\U0001F514 Desde ahora te avisaré de los cambios apenas los detecte.\n" \
+               "Para recibir un resumen periódico en su lugar, envía /resumen nuevamente."
+    try_msg(context.bot,
+            chat_id=update.message.chat_id,
+            text=text)
+
+
+def history_change_to_string(change):
+    result = "<i>{}</i> <b>{}</b> ".format(datetime.fromtimestamp(change.time).strftime("%d/%m %H:%M"), change.curso)
+    if change.seccion is None:
+        if change.change == "added":
+            return result + "Curso añadido\n"
+        if change.change == "deleted":
+            return result + "Curso eliminado\n"
+        return result + "Nombre: <i>{}</i> \U000027A1 <b>{}</b>\n" \
+            .format(json.loads(change.old), json.loads(change.new))
+    result += "Sección {}: ".format(change.seccion)
+    if change.change == "added":
+        return result + "añadida\n"
+    if change.change == "deleted":
+        return result + "eliminada\n"
+    (old, new) = (json.loads(change.old), json.loads(change.new))
+    if change.field == "horarios":
+        return result + "horario\n" + horarios_diff_to_string(Horario.from_json(old), Horario.from_json(new), 4)
+    if change.field == "profesores":
+        (old, new) = (", ".join(old), ", ".join(new))
+    return result + "{} <i>{}</i> \U000027A1 <b>{}</b>\n".format(change.field, old, new)
+
+
+def history(update, context):
+    logger.info("[Command /historial]")
+    if not context.args:
+        try_msg(context.bot,
+                chat_id=update.message.chat_id,
+                parse_mode="HTML",
+                text="Indícame de qué curso o departamento quieres ver el historial de cambios y, opcionalmente, "
+                     "cuántos días hacia atrás (por defecto {}).\n"
+                     "<i>Ej. /historial 5-CC3001 30</i>\n<i>Ej. /historial 5</i>".format(HISTORY_DEFAULT_DAYS))
+        return
+
+    (d_arg, _, c_arg) = context.args[0].partition("-")
+    c_arg = c_arg.upper() or None
+    try:
+        days = int(context.args[1]) if len(context.args) > 1 else HISTORY_DEFAULT_DAYS
+    except ValueError:
+        days = None
+    if d_arg not in DEPTS or days is None or days <= 0:
+        try_msg(context.bot,
+                chat_id=update.message.chat_id,
+                parse_mode="HTML",
+                text="\U0001F914 No pude entender <i>{}</i>.\n<i>Ej. /historial 5-CC3001 30</i>\n\n"
+                     "Para ver la lista de códigos de deptos que reconozco envía /deptos"
+                .format(" ".join(context.args)))
+        return
+
+    days = min(days, HISTORY_MAX_DAYS)
+    since = (datetime.now() - timedelta(days=days)).timestamp()
+    changes = data.history.query(depto=d_arg, curso=c_arg, since=since, limit=HISTORY_MAX_CHANGES)
+    name = "{} de {}".format(c_arg, DEPTS[d_arg][1]) if c_arg else DEPTS[d_arg][1]
+    if not changes:
+        text = "No he registrado cambios en {} en los últimos {} días.".format(name, days)
+    else:
+        text = "<b>Cambios en {} en los últimos {} días</b>{}:\n\n".format(
+            name, days, " (últimos {})".format(HISTORY_MAX_CHANGES) if len(changes) == HISTORY_MAX_CHANGES else "")
+        text += "".join(history_change_to_string(x) for x in changes)
+    send_long_message(context.bot,
+                      chat_id=update.message.chat_id,
+                      parse_mode="HTML",
+                      text=text)
+
+
 def force_check(update, context):
     if int(update.message.from_user.id) in admin_ids:
         logger.info("[Command /force_check from admin %s]", update.message.from_user.id)
+        if data.scheduler is not None:
+            data.scheduler.force()
         job_check = jq.get_jobs_by_name("job_check")[0]
         job_check.run(dp)
 
@@ -327,31 +433,53 @@ def force_check_results(update, context):
         job_check.run(dp)
 
 
+def profile_check(update, context):
+    if int(update.message.from_user.id) in admin_ids:
+        logger.info("[Command /profile_check from admin %s]", update.message.from_user.id)
+        kind = "results" if context.args and context.args[0] == "results" else "catalog"
+        data.profile_requests[kind] = update.message.from_user.id
+        try_msg(context.bot,
+                chat_id=update.message.from_user.id,
+                text="Next {} check will be profiled. Use /{} to run it now."
+                .format(kind, "force_check_results" if kind == "results" else "force_check"))
+
+
 def get_log(update, context):
     if int(update.message.from_user.id) in admin_ids:
         logger.info("[Command /get_log from admin %s]", update.message.from_user.id)
-        context.bot.send_document(chat_id=update.message.from_user.id,
-                                  document=open(os.path.relpath('bot.log'), 'rb'),
-                                  filename="catalogobot_log_{}.txt"
-                                  .format(datetime.now().strftime("%d%b%Y-%H%M%S")))
+        send_file(context.bot, update.message.from_user.id, os.path.relpath('bot.log'),
+                  "catalogobot_log_{}.txt".format(datetime.now().strftime("%d%b%Y-%H%M%S")))
+
+
+def show_metrics(update, context):
+    if int(update.message.from_user.id) in admin_ids:
+        logger.info("[Command /metrics from admin %s]", update.message.from_user.id)
+        send_long_message(context.bot,
+                          chat_id=update.message.from_user.id,
+                          text="<pre>{}</pre>".format(escape(metrics.summary())),
+                          parse_mode="HTML")
 
 
 def get_chats_data(update, context):
     if int(update.message.from_user.id) in admin_ids:
         logger.info("[Command /get_chats_data from admin %s]", update.message.from_user.id)
         try:
-            db_path = os.path.relpath('db')
-            with open(db_path, 'rb') as logfile:
-                json_result = json.dumps(pickle.load(logfile), sort_keys=True, indent=4)
-            with tempfile.NamedTemporaryFile(delete=False, mode="w+t") as temp_file:
-                temp_filename = temp_file.name
-                temp_file.write(json_result)
-            with open(temp_filename, 'rb') as temp_doc:
-                context.bot.send_document(chat_id=update.message.from_user.id,
-                                          document=temp_doc,
-                                          filename="catalogobot_chat_data_{}.txt"
-                                          .format(datetime.now().strftime("%d%b%Y-%H%M%S")))
-            os.remove(temp_filename)
+            json_result = json.dumps(data.persistence.dump(), sort_keys=True, indent=4)
+            send_generated_file(context.bot, update.message.from_user.id,
+                                "catalogobot_chat_data_{}.txt".format(datetime.now().strftime("%d%b%Y-%H%M%S")),
+                                lambda temp_file: temp_file.write(json_result))
+        except Exception as e:
+            logger.exception(e)
+
+
+def get_catalog(update, context):
+    if int(update.message.from_user.id) in admin_ids:
+        logger.info("[Command /get_catalog from admin %s]", update.message.from_user.id)
+        try:
+            send_generated_file(context.bot, update.message.from_user.id,
+                                "catalogobot_catalog_{}-{}_{}.json"
+                                .format(YEAR, SEMESTER, datetime.now().strftime("%d%b%Y-%H%M%S")),
+                                lambda temp_file: export_json(data.current_data, temp_file))
         except Exception as e:
             logger.exception(e)
 
@@ -363,13 +491,9 @@ def force_notification(update, context):
         if context.args:
             message = update.message.text
             message = message[message.index(" ")+1:].replace("\\", "")
-            for chat_id in chats_data:
-                try_msg(context.bot,
-                        chat_id=chat_id,
-                        force=True,
-                        text=message,
-                        parse_mode="Markdown",
-                        )
+            data.notifier.broadcast("force_notification",
+                                    {chat_id: [message] for chat_id in list(chats_data)},
+                                    parse_mode="Markdown")
 
 
 def notification(update, context):
@@ -379,13 +503,10 @@ def notification(update, context):
         if context.args:
             message = update.message.text
             message = message[message.index(" ")+1:].replace("\\", "")
-            for chat_id in chats_data:
-                if chats_data[chat_id].get("enable", False):
-                    try_msg(context.bot,
-                            chat_id=chat_id,
-                            text=message,
-                            parse_mode="Markdown",
-                            )
+            data.notifier.broadcast("notification",
+                                    {chat_id: [message] for chat_id in list(chats_data)
+                                     if chats_data[chat_id].get("enable", False)},
+                                    parse_mode="Markdown")
 
 
 def enable_check_results(update, context):
@@ -427,6 +548,8 @@ def changes_check_interval(update, context):
             except ValueError:
                 logger.error(f'{context.args[0]} is not a valid interval value')
                 return
+            if data.scheduler is not None:
+                data.scheduler.set_max_interval(data.config["changes_check_interval"])
             save_config()
             notif = "Changes check interval: {} seconds".format(str(data.config["changes_check_interval"]))
             try_msg(context.bot,
@@ -461,8 +584,11 @@ def admin_help(update, context):
                 chat_id=admin_ids[0],
                 text=
                 '/force_check\n'
+                '/profile_check [results]\n'
                 '/get_log\n'
                 '/get_chats_data\n'
+                '/get_catalog\n'
+                '/metrics\n'
                 '/notification\n'
                 '/force_notification\n'
                 '/force_check_results\n'
@@ -1,5 +1,75 @@
+import pickle
+import sqlite3
+import threading
+from collections import defaultdict
+from copy import deepcopy
 from os import path
 
-from telegram.ext import PicklePersistence
+from telegram.ext import BasePersistence
+
+from config.logger import logger
+from metrics import PERSISTENCE_SECONDS
+
+
+class SQLitePersistence(BasePersistence):
+    # Guarda el chat_data de cada chat en su propia fila (pickle de su diccionario), de modo que un cambio en un
+    # chat sólo reescribe esa fila y no la base completa como PicklePersistence.
+    # El Dispatcher llama a update_chat_data para el chat de cada update, y para todos los chats al detenerse; los
+    # cambios a otros chats se guardan con utils.save_chat_data. Se compara con la última versión guardada y sólo
+    # se escribe si cambió.
+
+    def __init__(self, filename, legacy_pickle_filename=None):
+        super().__init__(store_user_data=False, store_chat_data=True)
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS chat_data (chat_id INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+        self.chat_data = None  # Última versión guardada de cada chat
+        if legacy_pickle_filename is not None and path.exists(legacy_pickle_filename) and self._is_empty():
+            self._migrate(legacy_pickle_filename)
+
+    def _is_empty(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM chat_data").fetchone()[0] == 0
+
+    # Importa los chats guardados por PicklePersistence (archivo único). El archivo antiguo no se modifica.
+    def _migrate(self, legacy_pickle_filename):
+        with open(legacy_pickle_filename, "rb") as legacy_file:
+            legacy_chat_data = pickle.load(legacy_file)["chat_data"]
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO chat_data (chat_id, data) VALUES (?, ?)",
+                                  [(chat_id, pickle.dumps(chat_data)) for chat_id, chat_data in legacy_chat_data.items()])
+        logger.info("Migrated %s chats from %s to %s.", len(legacy_chat_data), legacy_pickle_filename, self.filename)
+
+    def _load(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT chat_id, data FROM chat_data").fetchall()
+        self.chat_data = defaultdict(dict, ((chat_id, pickle.loads(blob)) for chat_id, blob in rows))
+
+    def get_chat_data(self):
+        if self.chat_data is None:
+            self._load()
+        return deepcopy(self.chat_data)
+
+    def update_chat_data(self, chat_id, data):
+        if self.chat_data is None:
+            self._load()
+        if self.chat_data.get(chat_id) == data:
+            return
+        blob = pickle.dumps(data)
+        with self.lock, PERSISTENCE_SECONDS.time(store="chat_data"), self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO chat_data (chat_id, data) VALUES (?, ?)", (chat_id, blob))
+            self.chat_data[chat_id] = pickle.loads(blob)
+
+    # Los datos guardados en la base, para exportarlos (ver /get_chats_data)
+    def dump(self):
+        if self.chat_data is None:
+            self._load()
+        with self.lock:
+            return {"chat_data": deepcopy(self.chat_data)}
+
+    # Cada cambio se escribe apenas llega, no queda nada pendiente
+    def flush(self):
+        pass
 
-persistence = PicklePersistence(path.relpath('db'), on_flush=False)
@@ -1,6 +1,10 @@
 YEAR = "2022"
 SEMESTER = "1"  # 1: Otoño, 2: Primavera, 3: Verano
 
+# Se pueden cambiar en config/bot.json ("ucampus_url", "ucursos_url"), p. ej. para usar benchmarks/fake_server.py
+UCAMPUS_URL = "https://ucampus.uchile.cl"
+UCURSOS_URL = "https://www.u-cursos.cl"
+
 DEPTS = {  # id: [Cód, Nombre]
     "12060003": ["AA", "Área para el Aprendizaje de la Ingeniería y Ciencias A2IC"],
     "3": ["AS", "Departamento de Astronomía"],
@@ -1,19 +1,40 @@
 from datetime import datetime
+from os import path
 
 from telegram.ext import Updater
 
 from config.auth import token
-from config.persistence import persistence
+from config.persistence import SQLitePersistence
+from model import Catalog
+from subscription_index import SubscriptionIndex
 
 last_check_time = datetime.now()
 
-current_data = {}  # Lista de cursos de última consulta
-new_data = {}  # Lista de cursos de nueva consulta
+current_data = Catalog()  # Lista de cursos de última consulta (ver model.py)
+new_data = Catalog()  # Lista de cursos de nueva consulta
+unsaved_deptos = set()  # Deptos de current_data que cambiaron desde el último guardado
+fetch_cache = {}  # ETag, Last-Modified y hash de la respuesta de cada depto en current_data
+new_fetch_cache = {}  # Lo mismo, para las respuestas de new_data
+current_fingerprints = {}  # Hashes de deptos, cursos y secciones de current_data (ver diff.py)
+new_fingerprints = {}  # Lo mismo, para new_data
+notice_renderer = None  # Avisos de los cambios del check en curso (ver render.ChangeRenderer)
+pending_notices = {}  # {chat_id: [(depto_id, curso_id o None)]} por enviar al terminar el check en curso
+pending_notice_keys = []  # Llaves de los cambios en pending_notices (ver notify_changes)
 
 
+persistence = SQLitePersistence(path.relpath('db.sqlite'), legacy_pickle_filename=path.relpath('db'))
 updater = Updater(token=token, use_context=True, persistence=persistence)
 dp = updater.dispatcher
 jq = updater.job_queue
+subscriptions = SubscriptionIndex()  # Chats suscritos a cada depto y curso, se construye al iniciar
+results_cache = {}  # ETag y Last-Modified de la última respuesta de novedades
+snapshot_store = None  # Dónde se guarda current_data (ver snapshot.py), se crea al cargar la configuración
+fetcher = None  # Cliente HTTP compartido (ver fetcher.py), se crea al cargar la configuración
+scheduler = None  # Qué deptos consultar en cada check (ver scheduler.py), si "adaptive_polling" está activado
+notifier = None  # Envía los avisos a los chats (ver notifier.py), se crea al cargar la configuración
+outbox = None  # Mensajes pendientes de envío (ver outbox.py)
+history = None  # Historial de cambios del catálogo (ver history.py)
+profile_requests = {}  # {"catalog" o "results": admin que pidió perfilar el próximo check (ver /profile_check)}
 job_check_results = None
 job_check_changes = None
 
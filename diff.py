@@ -0,0 +1,98 @@
+import hashlib
+
+
+# Cada depto se resume con un hash estable de sus cursos, y cada curso con uno de sus secciones:
+# fingerprint = {"hash": "...",
+#                "cursos": {"CC3001": {"hash": "...",
+#                                      "secciones": {"1": "...", "2": "..."}}}}
+# Así, los subárboles sin cambios se descartan comparando un solo hash.
+
+
+def _sha1(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+# repr() de strings, enteros y tuplas no depende del proceso, así que sirve en los workers de parsers.py
+def fingerprint_seccion(seccion):
+    return _sha1(repr(seccion.key()))
+
+
+def fingerprint_curso(curso):
+    secciones = {s_id: fingerprint_seccion(seccion) for s_id, seccion in curso.secciones.items()}
+    curso_hash = _sha1(repr((curso.nombre, sorted(secciones.items()))))
+    return {"hash": curso_hash, "secciones": secciones}
+
+
+def fingerprint_depto(depto_data):
+    cursos = {c_id: fingerprint_curso(curso) for c_id, curso in depto_data.items()}
+    depto_hash = _sha1(repr(sorted((c_id, c["hash"]) for c_id, c in cursos.items())))
+    return {"hash": depto_hash, "cursos": cursos}
+
+
+def diff_seccion(old_seccion, new_seccion):
+    mods_sec = {}
+    if old_seccion.profesores != new_seccion.profesores:
+        mods_sec["profesores"] = [old_seccion.profesores, new_seccion.profesores]
+    if old_seccion.cupos != new_seccion.cupos:
+        mods_sec["cupos"] = [old_seccion.cupos, new_seccion.cupos]
+    if old_seccion.horarios != new_seccion.horarios:
+        mods_sec["horarios"] = [old_seccion.horarios, new_seccion.horarios]
+    return mods_sec
+
+
+def diff_curso(old_curso, new_curso, old_fp, new_fp):
+    mods = {}
+    if old_curso.nombre != new_curso.nombre:
+        mods["nombre"] = [old_curso.nombre, new_curso.nombre]
+    old_secciones = set(old_curso.secciones.keys())
+    new_secciones = set(new_curso.secciones.keys())
+    changes_sec = {}
+    added_sec = new_secciones - old_secciones
+    deleted_sec = old_secciones - new_secciones
+    modified_sec = {}
+    for s_id in old_secciones & new_secciones:
+        if old_fp["secciones"][s_id] == new_fp["secciones"][s_id]:
+            continue
+        mods_sec = diff_seccion(old_curso.secciones[s_id], new_curso.secciones[s_id])
+        if len(mods_sec) > 0:
+            modified_sec[s_id] = mods_sec
+
+    if len(added_sec) > 0:
+        changes_sec["added"] = added_sec
+    if len(deleted_sec) > 0:
+        changes_sec["deleted"] = deleted_sec
+    if len(modified_sec) > 0:
+        changes_sec["modified"] = modified_sec
+
+    if len(changes_sec) > 0:
+        mods["secciones"] = changes_sec
+    return mods
+
+
+# Entrega los cambios de un depto en el formato que consume notify_changes, o {} si no hay cambios.
+def diff_depto(old_cursos_data, new_cursos_data, old_fp, new_fp):
+    if old_cursos_data is new_cursos_data or old_fp["hash"] == new_fp["hash"]:
+        return {}
+
+    added = [x for x in new_cursos_data if x not in old_cursos_data]
+    deleted = [x for x in old_cursos_data if x not in new_cursos_data]
+    modified = {}
+    for c_id in old_cursos_data:
+        if c_id not in new_cursos_data:
+            continue
+        old_curso_fp = old_fp["cursos"][c_id]
+        new_curso_fp = new_fp["cursos"][c_id]
+        if old_curso_fp["hash"] == new_curso_fp["hash"]:
+            continue
+        mods = diff_curso(old_cursos_data[c_id], new_cursos_data[c_id], old_curso_fp, new_curso_fp)
+        if len(mods) > 0:
+            modified[c_id] = mods
+
+    changes = {}
+    if added:
+        changes["added"] = added
+    if deleted:
+        changes["deleted"] = deleted
+    if modified:
+        changes["modified"] = modified
+    return changes
@@ -0,0 +1,83 @@
+import asyncio
+import random
+import ssl
+import threading
+from collections import namedtuple
+
+import aiohttp
+
+from config.logger import logger
+
+Response = namedtuple("Response", ["status", "headers", "body", "encoding"])
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class FetchError(aiohttp.ClientError):
+    pass
+
+
+class Fetcher:
+    # Cliente HTTP de larga vida. Mantiene un event loop propio en un thread aparte y una sola ClientSession,
+    # de modo que las conexiones keep-alive se reutilizan entre un check y el siguiente.
+
+    def __init__(self, limit_per_host=6, timeout=20, retries=3, backoff=1.0):
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run_loop, name="Fetcher", daemon=True)
+        self.thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    # Agenda la corrutina en el loop del fetcher desde cualquier thread. Entrega un concurrent.futures.Future.
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        return self.submit(coro).result()
+
+    def _get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host, ssl=ssl.SSLContext())
+            self.session = aiohttp.ClientSession(connector=connector,
+                                                 timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    async def get(self, url, headers=None):
+        session = self._get_session()
+        attempt = 0
+        while True:
+            try:
+                async with session.get(url, headers=headers) as response:
+                    body = await response.read()
+                    if response.status not in RETRY_STATUSES or attempt >= self.retries:
+                        return Response(response.status, response.headers, body, response.get_encoding())
+                    reason = "HTTP {}".format(response.status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self.retries:
+                    raise
+                reason = "{}: {}".format(type(e).__name__, e)
+            attempt += 1
+            delay = self.backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+            logger.warning("[Attempt %s/%s] GET %s failed (%s). Retrying in %.1f s.",
+                           attempt, self.retries, url, reason, delay)
+            await asyncio.sleep(delay)
+
+    # POST con cuerpo JSON, sin reintentos (quien llama decide cómo reintentar, p. ej. AsyncBot)
+    async def post(self, url, payload):
+        async with self._get_session().post(url, json=payload) as response:
+            return Response(response.status, response.headers, await response.read(), response.get_encoding())
+
+    async def _close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    def close(self):
+        self.run(self._close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
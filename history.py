@@ -0,0 +1,107 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+# Historial de cambios del catálogo. Cada cambio detectado se guarda como una fila (solo se agregan filas,
+# nunca se modifican), de modo que el tamaño crece con la cantidad de cambios y no con el del catálogo.
+#   change: "added", "deleted" o "modified"
+#   field: None para cursos o secciones añadidos/eliminados, o "nombre", "profesores", "cupos", "horarios"
+#   old, new: JSON del valor anterior y nuevo (o del curso/sección completo al añadirse o eliminarse)
+
+Change = namedtuple("Change", ["time", "depto", "curso", "seccion", "field", "change", "old", "new"])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS changes (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    depto TEXT NOT NULL,
+    curso TEXT NOT NULL,
+    seccion TEXT,
+    field TEXT,
+    change TEXT NOT NULL,
+    old TEXT,
+    new TEXT
+);
+CREATE INDEX IF NOT EXISTS changes_curso ON changes (depto, curso, time);
+CREATE INDEX IF NOT EXISTS changes_time ON changes (time);
+"""
+
+
+def _to_json(value):
+    if value is None:
+        return None
+    if hasattr(value, "to_json"):
+        value = value.to_json()
+    elif isinstance(value, tuple):
+        value = list(value)
+    return json.dumps(value, ensure_ascii=False)
+
+
+def flatten_changes(d_id, changes, old_depto, new_depto):
+    rows = []
+    for c_id in changes.get("added", []):
+        rows.append((d_id, c_id, None, None, "added", None, _to_json(new_depto[c_id])))
+    for c_id in changes.get("deleted", []):
+        rows.append((d_id, c_id, None, None, "deleted", _to_json(old_depto[c_id]), None))
+    for c_id, mods in changes.get("modified", {}).items():
+        if "nombre" in mods:
+            rows.append((d_id, c_id, None, "nombre", "modified", _to_json(mods["nombre"][0]),
+                         _to_json(mods["nombre"][1])))
+        secciones = mods.get("secciones", {})
+        for s_id in sorted(secciones.get("added", [])):
+            rows.append((d_id, c_id, s_id, None, "added", None, _to_json(new_depto[c_id].secciones[s_id])))
+        for s_id in sorted(secciones.get("deleted", [])):
+            rows.append((d_id, c_id, s_id, None, "deleted", _to_json(old_depto[c_id].secciones[s_id]), None))
+        for s_id, mods_sec in secciones.get("modified", {}).items():
+            for field, (old_value, new_value) in mods_sec.items():
+                rows.append((d_id, c_id, s_id, field, "modified", _to_json(old_value), _to_json(new_value)))
+    return rows
+
+
+class HistoryStore:
+    def __init__(self, filename):
+        if filename != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.executescript(SCHEMA)
+
+    def record(self, d_id, changes, old_depto, new_depto, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        rows = [(timestamp,) + row for row in flatten_changes(d_id, changes, old_depto, new_depto)]
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT INTO changes (time, depto, curso, seccion, field, change, old, new) "
+                                  "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    # Entrega los cambios que cumplen todos los filtros dados, desde el check más reciente al más antiguo
+    def query(self, depto=None, curso=None, seccion=None, field=None, since=None, until=None, limit=None):
+        conditions = []
+        params = []
+        for (column, value) in (("depto", depto), ("curso", curso), ("seccion", seccion), ("field", field)):
+            if value is not None:
+                conditions.append("{} = ?".format(column))
+                params.append(value)
+        if since is not None:
+            conditions.append("time >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("time < ?")
+            params.append(until)
+        sql = "SELECT time, depto, curso, seccion, field, change, old, new FROM changes"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY time DESC, id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self.lock:
+            return [Change(*row) for row in self.conn.execute(sql, params)]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
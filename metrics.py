@@ -0,0 +1,260 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config.logger import logger
+
+# Métricas del bot en memoria: contadores, gauges e histogramas, con labels opcionales (p. ej. el depto).
+# Se pueden leer en formato de texto de Prometheus en http://127.0.0.1:<metrics_port>/metrics (ver serve) o
+# resumidas con el comando /metrics (ver summary).
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for name, value in pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}  # {valores de los labels: valor}
+
+    def _key(self, labels):
+        return tuple(str(labels[x]) for x in self.labels)
+
+    def collect(self):
+        with self.lock:
+            return sorted(self.values.items())
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} {}".format(self.name, self.kind)]
+        for key, value in self.collect():
+            lines.append("{}{} {}".format(self.name, _format_labels(self.labels, key), value))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self):
+        with self.lock:
+            return sum(self.values.values())
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "count", "sum", "max")
+
+    def __init__(self, buckets):
+        self.buckets = [0] * (len(buckets) + 1)  # El último es +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            histogram = self.values.get(key)
+            if histogram is None:
+                histogram = self.values[key] = _HistogramValue(self.buckets)
+            histogram.buckets[bisect_left(self.buckets, value)] += 1
+            histogram.count += 1
+            histogram.sum += value
+            histogram.max = max(histogram.max, value)
+
+    # Mide cuánto tarda el bloque with, en segundos
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} histogram".format(self.name)]
+        with self.lock:
+            values = [(key, list(h.buckets), h.count, h.sum) for key, h in sorted(self.values.items())]
+        for key, buckets, count, total in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ("+Inf",), buckets):
+                cumulative += bucket
+                lines.append("{}_bucket{} {}".format(self.name, _format_labels(self.labels, key, [("le", bound)]),
+                                                     cumulative))
+            lines.append("{}_sum{} {}".format(self.name, _format_labels(self.labels, key), total))
+            lines.append("{}_count{} {}".format(self.name, _format_labels(self.labels, key), count))
+        return lines
+
+    # Cantidad, promedio, percentil 95 aproximado (límite superior de su bucket) y máximo, juntando todos los labels
+    # o sólo los de key
+    def stats(self, key=None):
+        with self.lock:
+            values = [h for k, h in self.values.items() if key is None or k == key]
+            buckets = [sum(x) for x in zip(*(h.buckets for h in values))]
+            count = sum(h.count for h in values)
+            total = sum(h.sum for h in values)
+            maximum = max((h.max for h in values), default=0.0)
+        if count == 0:
+            return None
+        (p95, cumulative) = (maximum, 0)
+        for bound, bucket in zip(self.buckets, buckets):
+            cumulative += bucket
+            if cumulative >= 0.95 * count:
+                p95 = min(bound, maximum)
+                break
+        return {"count": count, "mean": total / count, "p95": p95, "max": maximum}
+
+
+REGISTRY = []
+
+
+def _register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+def counter(name, documentation, labels=()):
+    return _register(Counter(name, documentation, labels))
+
+
+def gauge(name, documentation, labels=()):
+    return _register(Gauge(name, documentation, labels))
+
+
+def histogram(name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, documentation, labels, buckets))
+
+
+CHECK_SECONDS = histogram("catalogobot_check_seconds", "Duration of each check.", ["check"])
+FETCH_SECONDS = histogram("catalogobot_fetch_seconds", "Download time of each depto page.", ["depto"])
+FETCH_RESULTS = counter("catalogobot_fetch_total", "Depto downloads by result.", ["result"])
+POLL_INTERVAL = gauge("catalogobot_poll_interval_seconds", "Current polling interval of each depto.", ["depto"])
+PARSE_SECONDS = histogram("catalogobot_parse_seconds", "Parse and fingerprint time of a depto page.")
+DIFF_SECONDS = histogram("catalogobot_diff_seconds", "Diff time of a depto against its previous version.")
+RENDER_SECONDS = histogram("catalogobot_render_seconds", "Render time of the notices of a check.")
+QUEUE_DEPTH = gauge("catalogobot_notifier_queue_messages", "Messages queued in the notifier.")
+MESSAGES_SENT = counter("catalogobot_telegram_messages_sent_total", "Messages sent to Telegram.")
+TELEGRAM_ERRORS = counter("catalogobot_telegram_errors_total", "Telegram errors when sending, by type.", ["type"])
+PERSISTENCE_SECONDS = histogram("catalogobot_persistence_write_seconds", "Disk write time, by store.",
+                                ["store"])
+
+START_TIME = time.time()
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Sirve /metrics en un thread aparte, sólo para conexiones locales
+def serve(port, host="127.0.0.1"):
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.error("Couldn't start metrics server on port %s (%s).", port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="Metrics", daemon=True).start()
+    logger.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return server
+
+
+def _stats_line(label, stats):
+    return "{:<15} n={:<6} mean={:>8.1f} ms  p95<={:>8.1f} ms  max={:>8.1f} ms".format(
+        label, stats["count"], stats["mean"] * 1000, stats["p95"] * 1000, stats["max"] * 1000)
+
+
+_last_summary = (START_TIME, 0)
+
+
+# Resumen en texto para el comando /metrics
+def summary(slowest=5):
+    global _last_summary
+    now = time.time()
+    lines = ["Uptime: {:.1f} h".format((now - START_TIME) / 3600)]
+    for (label, metric, key) in (("Catalog check", CHECK_SECONDS, ("catalog",)),
+                                 ("Results check", CHECK_SECONDS, ("results",)),
+                                 ("Fetch", FETCH_SECONDS, None), ("Parse", PARSE_SECONDS, None),
+                                 ("Diff", DIFF_SECONDS, None), ("Render", RENDER_SECONDS, None)):
+        stats = metric.stats(key)
+        if stats is not None:
+            lines.append(_stats_line(label, stats))
+    for (store, _) in PERSISTENCE_SECONDS.collect():
+        lines.append(_stats_line("Write " + store[0], PERSISTENCE_SECONDS.stats(store)))
+
+    deptos = sorted(((FETCH_SECONDS.stats(key)["mean"], key[0]) for key, _ in FETCH_SECONDS.collect()), reverse=True)
+    if deptos:
+        lines.append("Slowest deptos: " + ", ".join("{} ({:.0f} ms)".format(d_id, mean * 1000)
+                                                    for mean, d_id in deptos[:slowest]))
+    fetches = FETCH_RESULTS.collect()
+    if fetches:
+        lines.append("Fetches: " + ", ".join("{} {}".format(count, key[0]) for key, count in fetches))
+
+    sent = MESSAGES_SENT.total()
+    (last_time, last_sent) = _last_summary
+    _last_summary = (now, sent)
+    lines.append("Messages sent: {} ({:.2f}/s since last /metrics)".format(
+        sent, (sent - last_sent) / (now - last_time) if now > last_time else 0))
+    lines.append("Queued: {}".format(sum(value for _, value in QUEUE_DEPTH.collect())))
+    errors = TELEGRAM_ERRORS.collect()
+    if errors:
+        lines.append("Telegram errors: " + ", ".join("{} {}".format(count, key[0]) for key, count in errors))
+    return "\n".join(lines)
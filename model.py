@@ -0,0 +1,220 @@
+import re
+from enum import IntEnum
+from sys import intern
+
+
+# Modelo en memoria del catálogo. Equivale a la estructura JSON descrita en bot.py, pero con clases con
+# __slots__, tuplas en vez de listas, strings internados (nombres de profesores, horarios, etc. se repiten
+# muchísimo entre secciones y entre una consulta y la siguiente) y cupos como enteros.
+# to_json() y from_json() convierten desde y hacia el formato JSON de siempre sin pérdida.
+
+
+def _int_or_string(cupos):
+    # Sólo se convierten los valores que vuelven al mismo string, para no perder nada al guardar
+    if cupos.isdigit() and str(int(cupos)) == cupos:
+        return int(cupos)
+    return intern(cupos)
+
+
+def _strings(values):
+    return tuple(intern(x) for x in values)
+
+
+class Dia(IntEnum):
+    LUNES = 0
+    MARTES = 1
+    MIERCOLES = 2
+    JUEVES = 3
+    VIERNES = 4
+    SABADO = 5
+    DOMINGO = 6
+
+
+DIAS = {"Lunes": Dia.LUNES, "Martes": Dia.MARTES, "Miércoles": Dia.MIERCOLES, "Jueves": Dia.JUEVES,
+        "Viernes": Dia.VIERNES, "Sábado": Dia.SABADO, "Domingo": Dia.DOMINGO}
+BLOQUE_RE = re.compile(r"^({}) (\d{{1,2}}):(\d{{2}}) - (\d{{1,2}}):(\d{{2}})$".format("|".join(DIAS)))
+
+
+class Bloque:
+    # Un bloque de horario, p. ej. "Martes 10:15 - 11:45". Se guarda el día y los minutos desde las 00:00 de
+    # inicio y fin para comparar y consultar sin volver a parsear, y el texto original como representación.
+    # Si el texto no tiene el formato esperado, dia, inicio y fin quedan en None y sólo se compara el texto.
+    __slots__ = ("tipo", "dia", "inicio", "fin", "texto")
+
+    def __init__(self, tipo, dia, inicio, fin, texto):
+        self.tipo = intern(tipo)
+        self.dia = Dia(dia) if dia is not None else None
+        self.inicio = inicio
+        self.fin = fin
+        self.texto = intern(texto)
+
+    @classmethod
+    def parse(cls, tipo, texto):
+        match = BLOQUE_RE.match(texto)
+        if not match:
+            return cls(tipo, None, None, None, texto)
+        (dia, h_inicio, m_inicio, h_fin, m_fin) = match.groups()
+        return cls(tipo, DIAS[dia], int(h_inicio) * 60 + int(m_inicio), int(h_fin) * 60 + int(m_fin), texto)
+
+    def key(self):
+        if self.dia is None:
+            return self.texto
+        return int(self.dia), self.inicio, self.fin
+
+    def __eq__(self, other):
+        return isinstance(other, Bloque) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __reduce__(self):
+        return Bloque, (self.tipo, self.dia, self.inicio, self.fin, self.texto)
+
+    def __str__(self):
+        return self.texto
+
+    def __repr__(self):
+        return "Bloque({!r}, {!r})".format(self.tipo, self.texto)
+
+
+def _bloques(tipo, values):
+    return tuple(x if isinstance(x, Bloque) else Bloque.parse(tipo, x) for x in values)
+
+
+def _semanas(values):
+    return tuple(x if isinstance(x, int) else _int_or_string(x) for x in values)
+
+
+class Horario:
+    __slots__ = ("catedra", "auxiliar", "control", "semanas")
+
+    TIPOS = ("catedra", "auxiliar", "control")
+
+    def __init__(self, catedra=(), auxiliar=(), control=(), semanas=()):
+        self.catedra = _bloques("catedra", catedra)
+        self.auxiliar = _bloques("auxiliar", auxiliar)
+        self.control = _bloques("control", control)
+        self.semanas = _semanas(semanas)  # Semanas de los controles
+
+    def key(self):
+        return (tuple(x.key() for x in self.catedra), tuple(x.key() for x in self.auxiliar),
+                tuple(x.key() for x in self.control), self.semanas)
+
+    # Entrega {tipo: (bloques eliminados, bloques añadidos)} para cada tipo de bloque que cambió, y
+    # {"semanas": (anteriores, nuevas)} si cambiaron las semanas de control.
+    def diff(self, other):
+        result = {}
+        for tipo in Horario.TIPOS:
+            old_bloques = getattr(self, tipo)
+            new_bloques = getattr(other, tipo)
+            removed = tuple(x for x in old_bloques if x not in new_bloques)
+            added = tuple(x for x in new_bloques if x not in old_bloques)
+            if removed or added:
+                result[tipo] = (removed, added)
+        if self.semanas != other.semanas:
+            result["semanas"] = (self.semanas, other.semanas)
+        return result
+
+    def __eq__(self, other):
+        return isinstance(other, Horario) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __reduce__(self):
+        return Horario, (self.catedra, self.auxiliar, self.control, self.semanas)
+
+    def __repr__(self):
+        return "Horario{}".format((self.catedra, self.auxiliar, self.control, self.semanas))
+
+    @classmethod
+    def from_json(cls, horarios):
+        return cls(horarios["catedra"], horarios["auxiliar"], horarios["control"][0], horarios["control"][1])
+
+    def to_json(self):
+        return {"catedra": [str(x) for x in self.catedra],
+                "auxiliar": [str(x) for x in self.auxiliar],
+                "control": [[str(x) for x in self.control], [str(x) for x in self.semanas]]}
+
+
+class Seccion:
+    __slots__ = ("profesores", "cupos", "horarios")
+
+    def __init__(self, profesores, cupos, horarios):
+        self.profesores = _strings(profesores)
+        self.cupos = cupos if isinstance(cupos, int) else _int_or_string(cupos)
+        self.horarios = horarios
+
+    def key(self):
+        return self.profesores, self.cupos, self.horarios.key()
+
+    def __eq__(self, other):
+        return isinstance(other, Seccion) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __reduce__(self):
+        return Seccion, (self.profesores, self.cupos, self.horarios)
+
+    def __repr__(self):
+        return "Seccion{}".format(self.key())
+
+    @classmethod
+    def from_json(cls, seccion):
+        return cls(seccion["profesores"], seccion["cupos"], Horario.from_json(seccion["horarios"]))
+
+    def to_json(self):
+        return {"profesores": list(self.profesores),
+                "cupos": str(self.cupos),
+                "horarios": self.horarios.to_json()}
+
+
+class Curso:
+    __slots__ = ("nombre", "secciones")
+
+    def __init__(self, nombre, secciones):
+        self.nombre = intern(nombre)
+        self.secciones = secciones  # {id de sección: Seccion}
+
+    def __eq__(self, other):
+        return isinstance(other, Curso) and self.nombre == other.nombre and self.secciones == other.secciones
+
+    def __reduce__(self):
+        return Curso, (self.nombre, self.secciones)
+
+    def __repr__(self):
+        return "Curso({!r}, {!r})".format(self.nombre, self.secciones)
+
+    @classmethod
+    def from_json(cls, curso):
+        return cls(curso["nombre"],
+                   {intern(s_id): Seccion.from_json(seccion) for s_id, seccion in curso["secciones"].items()})
+
+    def to_json(self):
+        return {"nombre": self.nombre,
+                "secciones": {s_id: seccion.to_json() for s_id, seccion in self.secciones.items()}}
+
+
+class Departamento(dict):
+    # {id de curso: Curso}
+    __slots__ = ()
+
+    @classmethod
+    def from_json(cls, depto):
+        return cls((intern(c_id), Curso.from_json(curso)) for c_id, curso in depto.items())
+
+    def to_json(self):
+        return {c_id: curso.to_json() for c_id, curso in self.items()}
+
+
+class Catalog(dict):
+    # {id de depto: Departamento}
+    __slots__ = ()
+
+    @classmethod
+    def from_json(cls, catalog):
+        return cls((d_id, Departamento.from_json(depto)) for d_id, depto in catalog.items())
+
+    def to_json(self):
+        return {d_id: depto.to_json() for d_id, depto in self.items()}
@@ -0,0 +1,190 @@
+import asyncio
+import itertools
+import threading
+import time
+
+from telegram import TelegramError
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from config.logger import logger
+from metrics import QUEUE_DEPTH, TELEGRAM_ERRORS
+from outbox import Message
+from render import split_message
+from utils import try_msg_async
+
+# Límites de Telegram: unos 30 mensajes por segundo en total, y no más de uno por segundo a un mismo chat
+GLOBAL_RATE = 30
+CHAT_INTERVAL = 1.0
+MAX_RETRY_AFTER = 3
+RETRY_BACKOFF = 5  # Segundos antes de reintentar un mensaje que no llegó a Telegram; se duplica en cada fallo
+MAX_RETRY_BACKOFF = 300
+
+# Prioridades de los envíos: con la cola llena se atienden primero los de menor número
+PRIORITY_HIGH = 0  # Avisos de los admins y novedades
+PRIORITY_NORMAL = 1  # Cambios en el catálogo
+PRIORITY_LOW = 2  # Resúmenes (ver digest)
+
+
+class RateLimiter:
+    # Reparte turnos de envío respetando el límite global y el de cada chat. Cada llamada a wait() reserva el
+    # próximo turno libre y espera hasta que llegue. Se usa sólo desde el event loop del notifier.
+
+    def __init__(self, rate=GLOBAL_RATE, chat_interval=CHAT_INTERVAL):
+        self.interval = 1 / rate
+        self.chat_interval = chat_interval
+        self.next_slot = 0
+        self.next_chat_slots = {}
+
+    async def wait(self, chat_id):
+        now = time.monotonic()
+        slot = max(now, self.next_slot, self.next_chat_slots.get(chat_id, 0))
+        self.next_slot = slot + self.interval
+        self.next_chat_slots[chat_id] = slot + self.chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    # Detiene todos los envíos por los segundos indicados (p. ej. después de un RetryAfter)
+    def pause(self, seconds):
+        self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+
+class _LimitedBot:
+    # Envuelve al bot para que cada send_message (también los de try_msg_async) pase
+    # por el RateLimiter. Si Telegram responde RetryAfter, se pausan todos los envíos y se reintenta.
+
+    def __init__(self, bot, limiter):
+        self.bot = bot
+        self.limiter = limiter
+
+    async def send_message(self, **params):
+        for _ in range(MAX_RETRY_AFTER):
+            await self.limiter.wait(params["chat_id"])
+            try:
+                return await self.bot.send_message(**params)
+            except RetryAfter as e:
+                TELEGRAM_ERRORS.inc(type=type(e).__name__)
+                logger.warning("Flood limit reached when messaging chat %s. Pausing for %s s.",
+                               params["chat_id"], e.retry_after)
+                self.limiter.pause(e.retry_after)
+        await self.limiter.wait(params["chat_id"])
+        return await self.bot.send_message(**params)
+
+
+class Fanout:
+    # Un envío masivo (p. ej. los avisos de un check). Registra cuánto tardó en enviarse a todos los chats.
+
+    def __init__(self, name, chats, priority=PRIORITY_NORMAL):
+        self.name = name
+        self.priority = priority
+        self.chats = chats
+        self.pending = chats
+        self.start_time = time.monotonic()
+        self.done = threading.Event()
+        if chats == 0:
+            self.done.set()
+
+    def chat_done(self):
+        self.pending -= 1
+        if self.pending > 0:
+            return
+        logger.info("Fan-out '%s' drained: %s chats in %.2f s.",
+                    self.name, self.chats, time.monotonic() - self.start_time)
+        self.done.set()
+
+    # Se puede llamar desde cualquier thread
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+class Notifier:
+    # Envía mensajes a muchos chats con un bot asíncrono (ver async_bot.py) y un número fijo de tareas en el event
+    # loop indicado, en vez de un thread por chat.
+    # Los mensajes de un mismo chat se envían en orden: después de cada uno, el resto vuelve a la cola cuando el
+    # chat pueda recibir el siguiente, y mientras tanto se atiende a otros chats.
+    # La cola atiende primero los envíos de mayor prioridad (p. ej. una novedad no espera a que terminen los
+    # resúmenes); entre los de igual prioridad, en orden de llegada.
+    # Los mensajes que vienen del outbox (ver outbox.py) se marcan como enviados ahí apenas Telegram los acepta, o
+    # si el error es permanente (chat bloqueado, BadRequest, token inválido, etc.). Si no llegan a Telegram
+    # (NetworkError, TimedOut o RetryAfter), el chat vuelve a la cola con backoff y el mensaje queda pendiente en
+    # el outbox; si es largo, se reintenta desde el primer trozo que no se alcanzó a enviar.
+
+    def __init__(self, bot, loop, workers=8, rate=GLOBAL_RATE, chat_interval=CHAT_INTERVAL, outbox=None):
+        self.bot = _LimitedBot(bot, RateLimiter(rate, chat_interval))
+        self.loop = loop
+        self.chat_interval = chat_interval
+        self.outbox = outbox
+        self.queue = None  # (prioridad, orden, (fanout, chat_id, [Message], fallos seguidos)), se crea en el loop
+        self.counter = itertools.count()
+        asyncio.run_coroutine_threadsafe(self._start(workers), loop).result()
+
+    async def _start(self, workers):
+        self.queue = asyncio.PriorityQueue()
+        self.tasks = [asyncio.ensure_future(self._work()) for _ in range(workers)]
+
+    async def _close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    # Detiene las tareas antes de cerrar el loop. Los mensajes del outbox que no alcanzaron a enviarse quedan
+    # pendientes ahí, y se envían al volver a iniciar el bot.
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+
+    # chat_messages: {chat_id: [texto, ...]}. params se pasan a cada send_message (parse_mode, etc.)
+    def broadcast(self, name, chat_messages, priority=PRIORITY_HIGH, **params):
+        return self.send(name, [Message(None, chat_id, text, params)
+                                for chat_id, messages in chat_messages.items() for text in messages], priority)
+
+    # messages: [Message], en el orden en que se deben enviar a cada chat. Se puede llamar desde cualquier thread.
+    def send(self, name, messages, priority=PRIORITY_NORMAL):
+        chat_messages = {}
+        for message in messages:
+            chat_messages.setdefault(message.chat_id, []).append(message)
+        fanout = Fanout(name, len(chat_messages), priority)
+        QUEUE_DEPTH.inc(len(messages))
+        for chat_id, messages in chat_messages.items():
+            self.loop.call_soon_threadsafe(self._put, fanout, chat_id, messages, 0)
+        return fanout
+
+    def _put(self, fanout, chat_id, messages, failures):
+        self.queue.put_nowait((fanout.priority, next(self.counter), (fanout, chat_id, messages, failures)))
+
+    async def _work(self):
+        while True:
+            (_, _, (fanout, chat_id, messages, failures)) = await self.queue.get()
+            message = messages.pop(0)
+            QUEUE_DEPTH.dec()
+            # Si el texto es largo se envía en varios trozos, desde el primero que falte
+            chunks = split_message(message.text)
+            sent_chunks = message.sent_chunks
+            try:
+                for chunk in chunks[sent_chunks:]:
+                    await try_msg_async(self.bot, chat_id=chat_id, text=chunk, **message.params)
+                    sent_chunks += 1
+                    if message.id is not None and sent_chunks < len(chunks):
+                        self.outbox.mark_chunks_sent(message.id, sent_chunks)
+            except BadRequest:
+                pass  # Ya quedó registrado en try_msg_async, no tiene sentido reintentarlo
+            except (NetworkError, RetryAfter) as e:
+                delay = min(RETRY_BACKOFF * 2 ** failures, MAX_RETRY_BACKOFF)
+                logger.warning("Couldn't notify chat %s (%s: %s). Retrying in %s s.",
+                               chat_id, type(e).__name__, e, delay)
+                messages.insert(0, message._replace(sent_chunks=sent_chunks))
+                QUEUE_DEPTH.inc()
+                self.loop.call_later(delay, self._put, fanout, chat_id, messages, failures + 1)
+                continue
+            except TelegramError as e:
+                logger.error("Messaging chat %s raised %s: %s. Aborting message.", chat_id, type(e).__name__, e)
+            except Exception:
+                # Queda pendiente en el outbox (junto con el resto para este chat) hasta el próximo reinicio
+                logger.exception("Uncaught exception occurred when notifying chat %s:", chat_id)
+                QUEUE_DEPTH.dec(len(messages))
+                fanout.chat_done()
+                continue
+            if message.id is not None:
+                self.outbox.mark_sent(message.id)
+            if messages:
+                self.loop.call_later(self.chat_interval, self._put, fanout, chat_id, messages, 0)
+            else:
+                fanout.chat_done()
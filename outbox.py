@@ -0,0 +1,140 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+# Cola persistente de mensajes por enviar. Los avisos se guardan aquí antes de avanzar y guardar el catálogo, y
+# se marcan como enviados recién después de enviarse, de modo que si el bot se cae a mitad de un envío masivo,
+# al reiniciar se envían los que faltaban (un mensaje puede llegar dos veces, pero no perderse).
+# Cada mensaje tiene una llave única (dedup_key): si el mismo cambio se vuelve a detectar después de un reinicio,
+# no se encola de nuevo. Para eso cada detección de un cambio en un depto lleva un número (ver change_seq), así un
+# cambio que se repite más adelante (p. ej. cupos que van y vuelven) tiene llaves nuevas y sí se avisa.
+# Los chats en modo resumen no reciben los avisos al tiro: sus bloques se acumulan en la tabla digest, y cada
+# cierto tiempo flush_digests los junta en mensajes y los pasa a la cola.
+
+# sent_chunks: cuántos trozos del texto (ver render.split_message) ya se enviaron, si se cortó en varios
+Message = namedtuple("Message", ["id", "chat_id", "text", "params", "sent_chunks"], defaults=(0,))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    dedup_key TEXT NOT NULL UNIQUE,
+    chat_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    params TEXT NOT NULL,
+    created REAL NOT NULL,
+    sent REAL,
+    sent_chunks INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (sent, id);
+CREATE TABLE IF NOT EXISTS digest (
+    id INTEGER PRIMARY KEY,
+    dedup_key TEXT NOT NULL UNIQUE,
+    chat_id INTEGER NOT NULL,
+    block TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS depto_changes (
+    d_id TEXT PRIMARY KEY,
+    old_hash TEXT NOT NULL,
+    new_hash TEXT NOT NULL,
+    seq INTEGER NOT NULL
+);
+"""
+
+SENT_RETENTION = 7 * 24 * 60 * 60  # Los enviados se guardan una semana, para seguir descartando duplicados
+
+
+class Outbox:
+    def __init__(self, filename):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.executescript(SCHEMA)
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(outbox)")]
+            if "sent_chunks" not in columns:
+                self.conn.execute("ALTER TABLE outbox ADD COLUMN sent_chunks INTEGER NOT NULL DEFAULT 0")
+
+    # Número de la detección de un cambio de old_hash a new_hash en el depto d_id. Si es el mismo cambio que se
+    # detectó la última vez, es porque se volvió a detectar sin que se alcanzara a guardar el catálogo (p. ej.
+    # después de un reinicio) y se entrega el mismo número; si no, uno nuevo.
+    def change_seq(self, d_id, old_hash, new_hash):
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT old_hash, new_hash, seq FROM depto_changes WHERE d_id = ?",
+                                    (d_id,)).fetchone()
+            if row is not None and row[:2] == (old_hash, new_hash):
+                return row[2]
+            seq = row[2] + 1 if row is not None else 1
+            self.conn.execute("INSERT OR REPLACE INTO depto_changes (d_id, old_hash, new_hash, seq) "
+                              "VALUES (?, ?, ?, ?)", (d_id, old_hash, new_hash, seq))
+            return seq
+
+    # messages: [(dedup_key, chat_id, text, params)]. Entrega los Message que no estaban encolados.
+    def enqueue(self, messages):
+        now = time.time()
+        result = []
+        with self.lock, self.conn:
+            for (dedup_key, chat_id, text, params) in messages:
+                cursor = self.conn.execute("INSERT OR IGNORE INTO outbox (dedup_key, chat_id, text, params, created) "
+                                           "VALUES (?, ?, ?, ?, ?)", (dedup_key, chat_id, text, json.dumps(params), now))
+                if cursor.rowcount == 1:
+                    result.append(Message(cursor.lastrowid, chat_id, text, params))
+        return result
+
+    def pending(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT id, chat_id, text, params, sent_chunks FROM outbox WHERE sent IS NULL "
+                                     "ORDER BY id")
+            return [Message(m_id, chat_id, text, json.loads(params), sent_chunks)
+                    for (m_id, chat_id, text, params, sent_chunks) in rows]
+
+    def mark_sent(self, message_id):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE outbox SET sent = ? WHERE id = ?", (time.time(), message_id))
+
+    # Registra que ya se enviaron los primeros sent_chunks trozos de un mensaje largo, para no repetirlos si hay
+    # que reintentar el resto
+    def mark_chunks_sent(self, message_id, sent_chunks):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE outbox SET sent_chunks = ? WHERE id = ?", (sent_chunks, message_id))
+
+    # blocks: [(dedup_key, chat_id, texto del bloque)]
+    def add_to_digest(self, blocks):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO digest (dedup_key, chat_id, block, created) "
+                                  "VALUES (?, ?, ?, ?)", [block + (now,) for block in blocks])
+
+    # Junta los bloques acumulados de cada chat en mensajes con coalesce(bloques) y los encola, todo en una sola
+    # transacción. Entrega los Message encolados.
+    def flush_digests(self, coalesce, params):
+        now = time.time()
+        result = []
+        with self.lock, self.conn:
+            chat_blocks = {}
+            last_id = None
+            for (block_id, chat_id, block) in self.conn.execute("SELECT id, chat_id, block FROM digest ORDER BY id"):
+                chat_blocks.setdefault(chat_id, []).append(block)
+                last_id = block_id
+            for chat_id, blocks in chat_blocks.items():
+                for (i, text) in enumerate(coalesce(blocks)):
+                    cursor = self.conn.execute("INSERT OR IGNORE INTO outbox (dedup_key, chat_id, text, params, created) "
+                                               "VALUES (?, ?, ?, ?, ?)",
+                                               ("digest:{}:{}:{}".format(last_id, chat_id, i), chat_id, text,
+                                                json.dumps(params), now))
+                    if cursor.rowcount == 1:
+                        result.append(Message(cursor.lastrowid, chat_id, text, params))
+            if last_id is not None:
+                self.conn.execute("DELETE FROM digest WHERE id <= ?", (last_id,))
+        return result
+
+    def purge(self):
+        with self.lock, self.conn:
+            return self.conn.execute("DELETE FROM outbox WHERE sent < ?", (time.time() - SENT_RETENTION,)).rowcount
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
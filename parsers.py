@@ -0,0 +1,300 @@
+import asyncio
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from html.parser import HTMLParser
+from sys import intern
+
+from bs4 import BeautifulSoup
+
+from config.logger import logger
+from diff import fingerprint_depto
+from metrics import PARSE_SECONDS
+from model import Departamento, Curso, Seccion, Horario
+
+
+def full_strip(st):
+    return st.replace("\n", "").replace("\t", "").strip(" ")
+
+
+def parse_horario(horarios_str):
+    catedra = auxiliar = control = semanas = ()
+    for el in horarios_str:
+        if not isinstance(el, str):
+            continue
+        el = full_strip(el)
+        if el.startswith("Cátedra"):
+            catedra = el.lstrip("Cátedra: ").split(", ")
+        elif el.startswith("Auxiliar"):
+            auxiliar = el.lstrip("Auxiliar: ").split(", ")
+        elif el.startswith("Control"):
+            controlsplit = el.split(", Semana: ")
+            control = controlsplit[0].lstrip("Control: ").split(", ")
+            semanas = controlsplit[1].split(", ") if len(controlsplit) > 1 else ()
+    return Horario(catedra, auxiliar, control, semanas)
+
+
+def parse_depto_soup(html):
+    dept_data = Departamento()
+    soup = BeautifulSoup(html, 'html.parser')
+
+    for curso_tag in soup.find_all("div", class_="ramo"):
+        curso_str = full_strip(curso_tag.find("h2").contents[0]).split(" ", 1)
+        curso_id = curso_str[0]
+        curso_nombre = curso_str[1]
+        curso_secciones = {}
+        for seccion_tag in curso_tag.find("tbody").find_all("tr"):
+            seccion_data = seccion_tag.find_all("td")
+            seccion_id = seccion_tag["id"].split("-")[1]
+            seccion_profesores = []
+            for tag in seccion_data[0].find("ul", class_="profes").find_all("h1"):
+                seccion_profesores.append(full_strip(tag.text))
+            seccion_cupos = full_strip(seccion_data[1].text)
+            seccion_horarios = parse_horario(seccion_data[3].contents)
+            curso_secciones[intern(seccion_id)] = Seccion(seccion_profesores, seccion_cupos, seccion_horarios)
+
+        dept_data[intern(curso_id)] = Curso(curso_nombre, curso_secciones)
+
+    return dept_data
+
+
+# Tags que html.parser de BeautifulSoup considera vacíos (no se cierran ni tienen contenido)
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link", "menuitem", "meta",
+             "param", "source", "track", "wbr", "basefont", "bgsound", "command", "frame", "image", "isindex",
+             "nextid", "spacer"}
+PRESERVE_WHITESPACE_TAGS = {"pre", "textarea"}
+_REMOVE_SPACES = str.maketrans("", "", "\x20\x0a\x09\x0c\x0d")
+
+
+class _Celda:
+    __slots__ = ("depth", "text", "direct", "profes_depth", "profes_done", "profes", "open_h1")
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.text = []
+        self.direct = []
+        self.profes_depth = None
+        self.profes_done = False
+        self.profes = None
+        self.open_h1 = []
+
+
+class _Ramo:
+    __slots__ = ("depth", "h2_depth", "h2_first", "tbody_depth", "tbody_done", "open_rows", "secciones")
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.h2_depth = None
+        self.h2_first = None
+        self.tbody_depth = None
+        self.tbody_done = False
+        self.open_rows = []
+        self.secciones = []
+
+
+class CatalogoHTMLParser(HTMLParser):
+    # Recorre la página una sola vez guardando sólo el estado del curso que se está leyendo, en lugar de
+    # construir el árbol completo. Replica las reglas del árbol de BeautifulSoup con 'html.parser' que
+    # afectan el resultado (tags vacíos, cierre de tags y colapso de strings con sólo espacios), de modo que
+    # entrega exactamente lo mismo que parse_depto_soup.
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []
+        self.ramo = None
+        self.open_cells = []
+        self.result = Departamento()
+
+    def handle_starttag(self, tag, attrs):
+        ramo = self.ramo
+        depth = len(self.stack)
+        if ramo is not None and ramo.h2_depth == depth and ramo.h2_first is None:
+            ramo.h2_first = False  # El primer hijo del h2 es un tag
+        if tag in VOID_TAGS:
+            return
+        self.stack.append(tag)
+        depth += 1
+        classes = (dict(attrs).get("class") or "").split()
+
+        if ramo is None:
+            if tag == "div" and "ramo" in classes:
+                self.ramo = _Ramo(depth)
+            return
+
+        if tag == "h2" and ramo.h2_depth is None and ramo.h2_first is None:
+            ramo.h2_depth = depth
+        elif tag == "tbody" and ramo.tbody_depth is None and not ramo.tbody_done:
+            ramo.tbody_depth = depth
+        elif tag == "tr" and ramo.tbody_depth is not None:
+            row = (depth, dict(attrs)["id"], [])
+            ramo.open_rows.append(row)
+            ramo.secciones.append(row)
+        elif tag == "td" and ramo.open_rows:
+            cell = _Celda(depth)
+            for row in ramo.open_rows:
+                row[2].append(cell)
+            self.open_cells.append(cell)
+        for cell in self.open_cells:
+            if tag == "ul" and "profes" in classes and cell.profes_depth is None and not cell.profes_done:
+                cell.profes_depth = depth
+                cell.profes = []
+            elif tag == "h1" and cell.profes_depth is not None:
+                cell.open_h1.append((depth, []))
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag not in self.stack:
+            return
+        while True:
+            depth = len(self.stack)
+            name = self.stack.pop()
+            self._close(depth)
+            if name == tag:
+                break
+
+    def handle_data(self, data):
+        if data.translate(_REMOVE_SPACES) == "" \
+                and not PRESERVE_WHITESPACE_TAGS.intersection(self.stack):
+            data = "\n" if "\n" in data else " "
+        ramo = self.ramo
+        if ramo is None:
+            return
+        depth = len(self.stack)
+        if ramo.h2_depth == depth and ramo.h2_first is None:
+            ramo.h2_first = data
+        for cell in self.open_cells:
+            cell.text.append(data)
+            if cell.depth == depth:
+                cell.direct.append(data)
+            for (_, h1_text) in cell.open_h1:
+                h1_text.append(data)
+
+    def close(self):
+        super().close()
+        while self.stack:
+            depth = len(self.stack)
+            self.stack.pop()
+            self._close(depth)
+
+    def _close(self, depth):
+        ramo = self.ramo
+        if ramo is None:
+            return
+        for cell in self.open_cells:
+            if cell.open_h1 and cell.open_h1[-1][0] == depth:
+                cell.profes.append(full_strip("".join(cell.open_h1.pop()[1])))
+            if cell.profes_depth == depth:
+                cell.profes_depth = None
+                cell.profes_done = True
+        if self.open_cells and self.open_cells[-1].depth == depth:
+            self.open_cells.pop()
+        if ramo.open_rows and ramo.open_rows[-1][0] == depth:
+            ramo.open_rows.pop()
+        if ramo.tbody_depth == depth:
+            ramo.tbody_depth = None
+            ramo.tbody_done = True
+        if ramo.h2_depth == depth:
+            ramo.h2_depth = None
+        if ramo.depth == depth:
+            self._add_curso(ramo)
+            self.ramo = None
+
+    def _add_curso(self, ramo):
+        curso_str = full_strip(ramo.h2_first).split(" ", 1)
+        curso_id = curso_str[0]
+        curso_nombre = curso_str[1]
+        if not ramo.tbody_done:
+            raise ValueError("Curso {} sin tabla de secciones".format(curso_id))
+        curso_secciones = {}
+        for (_, tr_id, cells) in ramo.secciones:
+            seccion_id = tr_id.split("-")[1]
+            if cells[0].profes is None:
+                raise ValueError("Sección {} de {} sin profesores".format(seccion_id, curso_id))
+            curso_secciones[intern(seccion_id)] = Seccion(cells[0].profes,
+                                                          full_strip("".join(cells[1].text)),
+                                                          parse_horario(cells[3].direct))
+        self.result[intern(curso_id)] = Curso(curso_nombre, curso_secciones)
+
+
+def parse_depto_stream(html):
+    parser = CatalogoHTMLParser()
+    parser.feed(html)
+    parser.close()
+    return parser.result
+
+
+PARSERS = {"soup": parse_depto_soup,
+           "stream": parse_depto_stream}
+
+
+def parse_and_fingerprint(parser_name, html):
+    dept_data = PARSERS[parser_name](html)
+    return dept_data, fingerprint_depto(dept_data)
+
+
+# Lo mismo, y además cuánto tardó. Se mide en el worker para no contar el tiempo que la página esperó en la cola
+# del pool.
+def _timed_parse_and_fingerprint(parser_name, html):
+    start = time.perf_counter()
+    result = parse_and_fingerprint(parser_name, html)
+    return result, time.perf_counter() - start
+
+
+_pool = None
+_pool_workers = 0
+
+
+# Los workers se crean con fork y heredan los handlers de señales del bot (los de Updater.idle), así que al
+# detener el bot con Ctrl-C o un SIGTERM a todo el grupo de procesos intentarían detener su copia del Updater y
+# se quedarían colgados. Ignoran SIGINT y mueren con SIGTERM; el bot los cierra con shutdown_pool.
+def _init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _get_pool(workers):
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != workers:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+        _pool_workers = workers
+    return _pool
+
+
+def _reset_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False)
+    _pool = None
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+    _pool = None
+
+
+async def _run_parse(parser_name, html, workers):
+    loop = asyncio.get_event_loop()
+    if workers > 1:
+        try:
+            return await loop.run_in_executor(_get_pool(workers), _timed_parse_and_fingerprint, parser_name, html)
+        except (BrokenProcessPool, OSError) as e:
+            logger.error("Parse pool failed (%s: %s). Parsing serially.", type(e).__name__, e)
+            _reset_pool()
+    return await loop.run_in_executor(None, _timed_parse_and_fingerprint, parser_name, html)
+
+
+# Parsea una página en el pool de procesos, dejando libre el event loop para seguir descargando otros deptos.
+# Con un solo worker, o si el pool falla, se parsea en serie en el executor por defecto del loop.
+async def parse_depto_async(parser_name, html, workers):
+    (result, elapsed) = await _run_parse(parser_name, html, workers)
+    PARSE_SECONDS.observe(elapsed)
+    return result
@@ -0,0 +1,59 @@
+import asyncio
+import cProfile
+import io
+import pstats
+
+# Perfilado de un check a pedido de un admin (ver /profile_check). Hasta Python 3.11 cProfile sólo mide el thread
+# donde se activa, así que además del thread del check se perfila el event loop del fetcher, donde corren las
+# descargas. El parse en el pool de procesos (parse_workers > 1) no se ve: aparece como espera en el thread del
+# check.
+
+TOP_FUNCTIONS = 20
+
+
+class CheckProfiler:
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.profile = cProfile.Profile()
+        self.loop_profile = None
+
+    async def _set_loop_profile(self, enable):
+        if enable:
+            self.loop_profile.enable()
+        else:
+            self.loop_profile.disable()
+
+    # Lanza ValueError si ya hay otro perfil activo (p. ej. el bot corre bajo cProfile desde Python 3.12), sin dejar
+    # nada activado
+    def start(self):
+        self.profile.enable()
+        if self.loop is not None:
+            self.loop_profile = cProfile.Profile()
+            try:
+                asyncio.run_coroutine_threadsafe(self._set_loop_profile(True), self.loop).result()
+            except ValueError:
+                # Desde Python 3.12 no puede haber dos perfiles activos a la vez, pero uno solo ve todos los threads
+                # (incluido el loop del fetcher)
+                self.loop_profile = None
+            except BaseException:
+                self.profile.disable()
+                raise
+
+    def stop(self):
+        self.profile.disable()
+        if self.loop_profile is not None:
+            asyncio.run_coroutine_threadsafe(self._set_loop_profile(False), self.loop).result()
+
+    def stats(self):
+        stats = pstats.Stats(self.profile)
+        if self.loop_profile is not None:
+            stats.add(self.loop_profile)
+        return stats
+
+
+# Las funciones con más tiempo propio, en texto. Le quita las carpetas a los nombres de archivo de stats.
+def hotspots(stats, top=TOP_FUNCTIONS):
+    output = io.StringIO()
+    stats.stream = output
+    stats.strip_dirs().sort_stats(pstats.SortKey.TIME).print_stats(top)
+    return "\n".join(line.rstrip() for line in output.getvalue().splitlines() if line.strip())
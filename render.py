@@ -0,0 +1,304 @@
+import re
+
+from telegram import constants as tg_constants
+
+from constants import DEPTS, YEAR, SEMESTER
+
+# Texto (HTML de Telegram) de los avisos. Las funciones reciben los datos anteriores y nuevos como parámetros y
+# no dependen del estado del bot.
+
+HORARIO_LABELS = {"catedra": "Cátedra", "auxiliar": "Auxiliar", "control": "Control"}
+BLOCK_SEPARATOR = "\n\n"
+CATALOG_LINK = "<a href='https://ucampus.uchile.cl/m/fcfm_catalogo/?semestre={}{}&depto={}'>\U0001F50D Ver catálogo</a>"
+
+
+TAG_RE = re.compile(r"<(/?)([a-zA-Z0-9]+)[^>]*>")
+MAX_ENTITY_LENGTH = 10
+
+
+# Tags, entidades (&...;) y saltos de línea: las partes del texto que split_message no corta
+_PIECE_RE = re.compile(r"<(/?)([a-zA-Z0-9]+)[^>]*>|&#?[a-zA-Z0-9]{1,%d};|\n" % (MAX_ENTITY_LENGTH - 3))
+(_TEXT, _ATOM, _OPEN, _CLOSE) = range(4)
+
+
+# Separa el texto en tags, entidades, saltos de línea y el texto entre ellos: [(tipo, texto, nombre del tag)]
+def _pieces(text):
+    pieces = []
+    position = 0
+    for match in _PIECE_RE.finditer(text):
+        if match.start() > position:
+            pieces.append((_TEXT, text[position:match.start()], None))
+        if match.group(2) is None:
+            pieces.append((_ATOM, match.group(0), None))
+        else:
+            pieces.append((_CLOSE if match.group(1) else _OPEN, match.group(0), match.group(2).lower()))
+        position = match.end()
+    if position < len(text):
+        pieces.append((_TEXT, text[position:], None))
+    return pieces
+
+
+def _closing(open_tags):
+    return "".join("</{}>".format(name) for (name, _, visible) in reversed(open_tags) if visible)
+
+
+# Arma el trozo que comienza en pieces[index] (saltándose sus primeros offset caracteres) con open_tags
+# ([(nombre, tag, visible)]) abiertos. Entrega (trozo, o None si ya no queda texto; tags abiertos al final del trozo;
+# index y offset donde comienza el siguiente).
+# El trozo llega hasta el último salto de línea (que se omite) antes de pasarse de max_length, o si no hay, hasta
+# donde quepa sin cortar un tag ni una entidad. Siempre lleva algo de texto, así que cada trozo avanza: si los tags
+# abiertos no dejan espacio (sólo pasa con un max_length muy chico) se dejan de mostrar hasta que se cierran, y los
+# tags que no caben ni solos se omiten.
+def _next_chunk(pieces, open_tags, index, offset, max_length):
+    open_tags = list(open_tags)
+    parts = [tag for (_, tag, visible) in open_tags if visible]
+    length = sum(map(len, parts))
+    closing = len(_closing(open_tags))
+    has_text = False
+    newline = None  # (len(parts), open_tags, index) en el último salto de línea del trozo, para cortar ahí
+    while index < len(pieces):
+        (kind, piece, name) = pieces[index]
+        piece = piece[offset:]
+        room = max_length - length - closing
+        if kind == _CLOSE:
+            i = next((i for i in range(len(open_tags) - 1, -1, -1) if open_tags[i][0] == name), None)
+            if i is None:
+                kind = _ATOM  # Un tag que cierra algo que no estaba abierto, se deja tal cual
+            else:
+                cost = len(piece) if open_tags[i][2] else 0
+                released = len(_closing(open_tags[i:]))
+                fits = cost - released <= room
+        if kind == _ATOM:
+            if len(piece) > max_length:
+                kind = _TEXT  # Más largo que max_length, no queda otra que cortarlo
+            elif piece == "\n" and has_text:
+                newline = (len(parts), list(open_tags), index + 1)
+        if kind == _OPEN:
+            fits = len(piece) + len(name) + 3 <= room
+        elif kind != _CLOSE:
+            fits = len(piece) <= room
+        if fits:
+            if kind == _OPEN:
+                open_tags.append((name, piece, True))
+                closing += len(name) + 3
+            elif kind == _CLOSE:
+                del open_tags[i:]
+                closing -= released
+                piece = piece if cost else ""
+            else:
+                has_text = has_text or piece != "\n"
+            parts.append(piece)
+            length += len(piece)
+            (index, offset) = (index + 1, 0)
+            continue
+        if newline is not None:
+            (cut, open_tags, index) = newline
+            return "".join(parts[:cut]) + _closing(open_tags), open_tags, index, 0
+        if kind == _TEXT and room > 0:
+            parts.append(piece[:room])
+            return "".join(parts) + _closing(open_tags), open_tags, index, offset + room
+        if has_text:
+            return "".join(parts) + _closing(open_tags), open_tags, index, offset
+        if parts:
+            # Los tags abiertos no dejan espacio para el texto: se dejan de mostrar
+            open_tags = [(name, tag, False) for (name, tag, _) in open_tags]
+            (parts, length, closing) = ([], 0, 0)
+            continue
+        # Queda un tag que no cabe ni solo (con el trozo vacío todo lo demás cabe): se omite
+        open_tags.append((name, piece, False))
+        index += 1
+    return ("".join(parts) + _closing(open_tags) if has_text else None), open_tags, index, 0
+
+
+# Corta el texto (HTML de Telegram) en trozos de a lo más max_length caracteres, de preferencia en un salto de
+# línea. Los tags que quedan abiertos en un corte se cierran al final del trozo y se vuelven a abrir al comienzo
+# del siguiente, para que cada trozo sea HTML válido por sí solo. Se omiten los trozos que quedan sólo con espacios,
+# porque Telegram no acepta mensajes vacíos.
+def split_message(text, max_length=tg_constants.MAX_MESSAGE_LENGTH):
+    if len(text) <= max_length:
+        return [text]
+    pieces = _pieces(text)
+    chunks = []
+    (open_tags, index, offset) = ([], 0, 0)
+    while index < len(pieces):
+        (chunk, open_tags, index, offset) = _next_chunk(pieces, open_tags, index, offset, max_length)
+        if chunk is not None and TAG_RE.sub("", chunk).strip():
+            chunks.append(chunk)
+    return chunks
+
+
+def horarios_lines(horarios, indent, lines):
+    prefix = " " * indent
+    if len(horarios.catedra) > 0:
+        lines.append(prefix + "<i>Cátedra: {}</i>\n".format(", ".join(map(str, horarios.catedra))))
+    if len(horarios.auxiliar) > 0:
+        lines.append(prefix + "<i>Auxiliar: {}</i>\n".format(", ".join(map(str, horarios.auxiliar))))
+    if len(horarios.control) > 0:
+        lines.append(prefix + "<i>Control: {}</i>\n".format(", ".join(map(str, horarios.control))))
+    if len(horarios.semanas) > 0:
+        lines.append(prefix + "<i>Semanas {}</i>\n".format(", ".join(map(str, horarios.semanas))))
+    return lines
+
+
+def horarios_diff_lines(old_horarios, new_horarios, indent, lines):
+    prefix = " " * indent
+    for (tipo, (removed, added)) in old_horarios.diff(new_horarios).items():
+        if tipo == "semanas":
+            lines.append(prefix + "Semanas de control: <i>{}</i> \U000027A1 <b>{}</b>\n"
+                         .format(", ".join(map(str, removed)) or "-", ", ".join(map(str, added)) or "-"))
+            continue
+        for bloque in removed:
+            lines.append(prefix + "\U00002796 <i>{}: {}</i>\n".format(HORARIO_LABELS[tipo], bloque))
+        for bloque in added:
+            lines.append(prefix + "\U00002795 <b>{}: {}</b>\n".format(HORARIO_LABELS[tipo], bloque))
+    return lines
+
+
+def horarios_to_string(horarios, indent):
+    return "".join(horarios_lines(horarios, indent, []))
+
+
+def horarios_diff_to_string(old_horarios, new_horarios, indent):
+    return "".join(horarios_diff_lines(old_horarios, new_horarios, indent, []))
+
+
+def added_curso_lines(curso_id, curso, lines):
+    lines.append("\U0001F4D7 <b>{} {}</b>\n".format(curso_id, curso.nombre))
+    for seccion_id, seccion in curso.secciones.items():
+        lines.append("    S{} - {} - {} cupos\n".format(seccion_id, ", ".join(seccion.profesores), seccion.cupos))
+        horarios_lines(seccion.horarios, 8, lines)
+    return lines
+
+
+def deleted_curso_lines(curso_id, curso, lines):
+    lines.append("\U0001F4D9 <b>{} {}</b>\n".format(curso_id, curso.nombre))
+    return lines
+
+
+def modified_curso_lines(curso_id, old_curso, new_curso, curso_mods, lines):
+    if "nombre" in curso_mods:
+        lines.append("\U0001F4D8 <b>{}</b> <i>{}</i>\n<i>Renombrado:</i> <b>{}</b>\n"
+                     .format(curso_id, curso_mods["nombre"][0], curso_mods["nombre"][1]))
+    else:
+        lines.append("\U0001F4D8 <b>{} {}</b>\n".format(curso_id, new_curso.nombre))
+    secciones_mods = curso_mods.get("secciones", {})
+    if "added" in secciones_mods:
+        lines.append("    <i>Secciones añadidas:</i>\n")
+        for seccion_id in secciones_mods["added"]:
+            seccion = new_curso.secciones[seccion_id]
+            lines.append("    \U00002795 Secc. {} - {} - {} cupos\n"
+                         .format(seccion_id, ", ".join(seccion.profesores), seccion.cupos))
+            horarios_lines(seccion.horarios, 8, lines)
+    if "deleted" in secciones_mods:
+        lines.append("    <i>Secciones eliminadas:</i>\n")
+        for seccion_id in secciones_mods["deleted"]:
+            seccion = old_curso.secciones[seccion_id]
+            lines.append("    \U00002796 Secc. {} - {}\n".format(seccion_id, ", ".join(seccion.profesores)))
+    if "modified" in secciones_mods:
+        lines.append("    <i>Secciones modificadas:</i>\n")
+        for seccion_id, seccion_mods in secciones_mods["modified"].items():
+            if "profesores" in seccion_mods:
+                lines.append("    \U00003030 <b>Sección {}</b>\n".format(seccion_id))
+                lines.append("        Cambia profesor\n")
+                lines.append("        \U00002013 de: <i>{}</i>\n".format(", ".join(seccion_mods["profesores"][0])))
+                lines.append("        \U00002013 a: <b>{}</b>\n".format(", ".join(seccion_mods["profesores"][1])))
+            else:
+                lines.append("    \U00003030 <b>Sección {}</b> - {}\n"
+                             .format(seccion_id, ", ".join(new_curso.secciones[seccion_id].profesores)))
+            if "cupos" in seccion_mods:
+                lines.append("        Cambia cupos\n")
+                lines.append("        \U00002013 de: <i>{}</i>\n".format(seccion_mods["cupos"][0]))
+                lines.append("        \U00002013 a: <b>{}</b>\n".format(seccion_mods["cupos"][1]))
+            if "horarios" in seccion_mods:
+                lines.append("        Cambia horario\n")
+                horarios_diff_lines(seccion_mods["horarios"][0], seccion_mods["horarios"][1], 12, lines)
+    return lines
+
+
+def changes_lines(changes, old_depto, new_depto, lines):
+    added = changes.get("added", [])
+    deleted = changes.get("deleted", [])
+    modified = changes.get("modified", {})
+    if len(added) > 0:
+        lines.append("\n<i>Cursos añadidos:</i>\n")
+        for curso_id in added:
+            added_curso_lines(curso_id, new_depto[curso_id], lines)
+    if len(deleted) > 0:
+        lines.append("\n<i>Cursos eliminados:</i>\n")
+        for curso_id in deleted:
+            deleted_curso_lines(curso_id, old_depto[curso_id], lines)
+    if len(modified) > 0:
+        lines.append("\n<i>Cursos modificados:</i>\n")
+        for curso_id, curso_mods in modified.items():
+            modified_curso_lines(curso_id, old_depto[curso_id], new_depto[curso_id], curso_mods, lines)
+    return lines
+
+
+# Junta los bloques (avisos de un depto o de un curso) en la menor cantidad de mensajes de a lo más max_length
+# caracteres, en orden. Un bloque más largo que eso se corta con split_message.
+def coalesce(blocks, max_length=tg_constants.MAX_MESSAGE_LENGTH):
+    messages = []
+    current = []
+    current_length = 0
+    for block in blocks:
+        for chunk in split_message(block, max_length):
+            length = current_length + len(BLOCK_SEPARATOR) + len(chunk) if current else len(chunk)
+            if current and length > max_length:
+                messages.append(BLOCK_SEPARATOR.join(current))
+                current = []
+                length = len(chunk)
+            current.append(chunk)
+            current_length = length
+    if current:
+        messages.append(BLOCK_SEPARATOR.join(current))
+    return messages
+
+
+class ChangeRenderer:
+    # Avisos de los cambios de un check. Cada bloque (el aviso de un depto completo o el de un curso) se arma una
+    # sola vez, y los mensajes de cada combinación de bloques se juntan una sola vez: los chats con las mismas
+    # suscripciones reciben la misma lista de mensajes.
+    # Los deptos se pueden agregar de a uno con add, a medida que se revisan.
+
+    def __init__(self, all_changes=None, old_catalog=None, new_catalog=None):
+        self.all_changes = all_changes if all_changes is not None else {}
+        self.old_catalog = old_catalog if old_catalog is not None else {}
+        self.new_catalog = new_catalog if new_catalog is not None else {}
+        self.blocks = {}
+        self.messages_cache = {}
+
+    def add(self, depto_id, changes, old_depto, new_depto):
+        self.all_changes[depto_id] = changes
+        self.old_catalog[depto_id] = old_depto
+        self.new_catalog[depto_id] = new_depto
+
+    # Texto del aviso de los cambios en el depto (curso_id None) o en uno de sus cursos
+    def block(self, depto_id, curso_id=None):
+        if (depto_id, curso_id) not in self.blocks:
+            changes = self.all_changes[depto_id]
+            old_depto = self.old_catalog.get(depto_id, {})
+            new_depto = self.new_catalog[depto_id]
+            if curso_id is None:
+                lines = ["<b>Cambios en {}</b>\n".format(DEPTS[depto_id][1])]
+                changes_lines(changes, old_depto, new_depto, lines)
+            elif curso_id in changes.get("added", []):
+                lines = ["<b>Curso añadido:</b>\n"]
+                added_curso_lines(curso_id, new_depto[curso_id], lines)
+            elif curso_id in changes.get("deleted", []):
+                lines = ["<b>Curso eliminado:</b>\n"]
+                deleted_curso_lines(curso_id, old_depto[curso_id], lines)
+            else:
+                lines = ["<b>Curso modificado:</b>\n"]
+                modified_curso_lines(curso_id, old_depto[curso_id], new_depto[curso_id],
+                                     changes["modified"][curso_id], lines)
+            lines.append("\n")
+            lines.append(CATALOG_LINK.format(YEAR, SEMESTER, depto_id))
+            self.blocks[(depto_id, curso_id)] = "".join(lines)
+        return self.blocks[(depto_id, curso_id)]
+
+    # Mensajes listos para enviar con los bloques indicados, como [(depto_id, curso_id o None)]
+    def messages(self, blocks):
+        blocks = tuple(blocks)
+        if blocks not in self.messages_cache:
+            self.messages_cache[blocks] = coalesce(self.block(depto_id, curso_id) for (depto_id, curso_id) in blocks)
+        return self.messages_cache[blocks]
@@ -0,0 +1,71 @@
+import threading
+import time
+
+from metrics import POLL_INTERVAL
+
+
+class PollScheduler:
+    # Decide qué deptos consultar en cada check. Cada depto tiene su propio intervalo: vuelve a min_interval cuando
+    # se detecta un cambio, y si no cambia se multiplica por backoff en cada consulta hasta llegar a max_interval.
+    # Así los deptos que están cambiando se consultan seguido y el resto cada vez menos.
+    # Además se respeta un máximo de budget consultas por minuto hacia U-Campus, repartido como un token bucket:
+    # si hay más deptos pendientes que consultas disponibles, se consultan primero los más atrasados.
+
+    def __init__(self, deptos, min_interval, max_interval, budget, backoff=1.5):
+        self.lock = threading.Lock()
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.budget = budget
+        self.backoff = backoff
+        self.tokens = budget
+        self.tokens_time = time.monotonic()
+        self.force_next = False
+        now = time.monotonic()
+        self.intervals = {d_id: max_interval for d_id in deptos}
+        self.next_poll = {d_id: now for d_id in deptos}
+        for d_id in deptos:
+            POLL_INTERVAL.set(max_interval, depto=d_id)
+
+    def _refill(self, now):
+        self.tokens = min(self.budget, self.tokens + (now - self.tokens_time) * self.budget / 60)
+        self.tokens_time = now
+
+    # Entrega los deptos que toca consultar ahora (todos, después de force) y agenda su próxima consulta como si
+    # no fueran a cambiar; update() la corrige con el resultado. Si una consulta falla, se reintenta después de
+    # su intervalo actual.
+    def take_due(self):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self.force_next:
+                self.force_next = False
+                due = list(self.next_poll)
+            else:
+                due = sorted((d_id for d_id, next_poll in self.next_poll.items() if next_poll <= now),
+                             key=lambda d_id: self.next_poll[d_id])[:max(int(self.tokens), 0)]
+            self.tokens -= len(due)
+            for d_id in due:
+                self.next_poll[d_id] = now + self.intervals[d_id]
+            return due
+
+    def update(self, d_id, changed):
+        with self.lock:
+            if changed:
+                interval = self.min_interval
+            else:
+                interval = min(self.max_interval, self.intervals[d_id] * self.backoff)
+            self.next_poll[d_id] += interval - self.intervals[d_id]
+            self.intervals[d_id] = interval
+        POLL_INTERVAL.set(interval, depto=d_id)
+
+    # El próximo take_due entrega todos los deptos, sin contar el presupuesto (p. ej. para /force_check)
+    def force(self):
+        with self.lock:
+            self.force_next = True
+
+    def set_max_interval(self, max_interval):
+        with self.lock:
+            self.max_interval = max_interval
+            for d_id, interval in self.intervals.items():
+                self.intervals[d_id] = min(interval, max_interval)
+                self.next_poll[d_id] = min(self.next_poll[d_id], time.monotonic() + max_interval)
@@ -0,0 +1,92 @@
+import json
+import marshal
+import os
+import tempfile
+from os import path
+
+from model import Catalog, Departamento
+
+# Formato binario: un directorio con un archivo por depto, <dept_id>.bin, con el JSON del depto serializado
+# con marshal. Así se puede leer un depto sin cargar el resto, y un cambio en un curso sólo reescribe el
+# archivo de su depto.
+MARSHAL_VERSION = 4
+EXTENSION = ".bin"
+
+
+# Escribe en un archivo temporal del mismo directorio y lo renombra, para que un corte a mitad de escritura
+# nunca deje un snapshot a medio escribir.
+def _atomic_write(filename, write):
+    directory = path.dirname(path.abspath(filename))
+    (fd, temp_filename) = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=path.basename(filename))
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            write(temp_file)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_filename, filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+
+
+def export_json(catalog, json_file):
+    json.dump(catalog.to_json(), json_file, indent=4)
+
+
+class JsonSnapshotStore:
+    def __init__(self, filename):
+        self.filename = filename
+
+    def exists(self):
+        return path.exists(self.filename)
+
+    def load(self):
+        with open(self.filename, "r") as datajsonfile:
+            return Catalog.from_json(json.load(datajsonfile))
+
+    def load_depto(self, dept_id):
+        return self.load().get(dept_id)
+
+    # Un solo archivo: siempre se reescribe completo, sin importar qué deptos cambiaron
+    def save(self, catalog, deptos=None):
+        _atomic_write(self.filename, lambda f: f.write(json.dumps(catalog.to_json(), indent=4).encode("utf-8")))
+
+
+class BinarySnapshotStore:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def exists(self):
+        return path.isdir(self.directory)
+
+    def _depto_filename(self, dept_id):
+        return path.join(self.directory, dept_id + EXTENSION)
+
+    def load(self):
+        catalog = Catalog()
+        for filename in sorted(os.listdir(self.directory)):
+            if filename.endswith(EXTENSION):
+                dept_id = filename[:-len(EXTENSION)]
+                catalog[dept_id] = self.load_depto(dept_id)
+        return catalog
+
+    def load_depto(self, dept_id):
+        try:
+            with open(self._depto_filename(dept_id), "rb") as depto_file:
+                return Departamento.from_json(marshal.loads(depto_file.read()))
+        except FileNotFoundError:
+            return None
+
+    # Escribe sólo los deptos indicados (todos si es None)
+    def save(self, catalog, deptos=None):
+        os.makedirs(self.directory, exist_ok=True)
+        for dept_id in (catalog if deptos is None else deptos):
+            blob = marshal.dumps(catalog[dept_id].to_json(), MARSHAL_VERSION)
+            _atomic_write(self._depto_filename(dept_id), lambda f: f.write(blob))
+
+
+def get_snapshot_store(snapshot_format, year, semester):
+    base = path.relpath('excluded/catalogdata-{}-{}'.format(year, semester))
+    if snapshot_format == "json":
+        return JsonSnapshotStore(base + ".json")
+    return BinarySnapshotStore(base)
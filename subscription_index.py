@@ -0,0 +1,63 @@
+import threading
+from collections import defaultdict
+
+
+class SubscriptionIndex:
+    # Índice invertido de suscripciones de los chats con avisos activados:
+    #   deptos: {id de depto: {chat_id}}
+    #   cursos: {(id de depto, id de curso): {chat_id}}
+    # Se actualiza chat por chat (update_chat) cada vez que cambian sus suscripciones o su estado, para que al
+    # notificar sólo se recorran los chats interesados en los cambios y no todos.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.deptos = defaultdict(set)
+        self.cursos = defaultdict(set)
+        self.chat_keys = {}  # {chat_id: (deptos, cursos)} indexados para cada chat, para poder sacarlo
+
+    def _remove(self, chat_id):
+        (deptos, cursos) = self.chat_keys.pop(chat_id, ((), ()))
+        for (index, keys) in ((self.deptos, deptos), (self.cursos, cursos)):
+            for key in keys:
+                index[key].discard(chat_id)
+                if not index[key]:
+                    del index[key]
+
+    def update_chat(self, chat_id, chat_data):
+        with self.lock:
+            self._remove(chat_id)
+            if not chat_data.get("enable", False):
+                return
+            deptos = set(chat_data.get("subscribed_deptos", []))
+            cursos = set(tuple(x) for x in chat_data.get("subscribed_cursos", []))
+            for d_id in deptos:
+                self.deptos[d_id].add(chat_id)
+            for d_c_id in cursos:
+                self.cursos[d_c_id].add(chat_id)
+            self.chat_keys[chat_id] = (deptos, cursos)
+
+    def remove_chat(self, chat_id):
+        with self.lock:
+            self._remove(chat_id)
+
+    def rebuild(self, chats_data):
+        with self.lock:
+            self.deptos.clear()
+            self.cursos.clear()
+            self.chat_keys.clear()
+        for chat_id, chat_data in list(chats_data.items()):
+            self.update_chat(chat_id, chat_data)
+
+    # Entrega {chat_id: (deptos, cursos)} con los deptos y (depto, curso) suscritos por cada chat que
+    # aparecen en all_changes (mismo formato que en notify_changes)
+    def matches(self, all_changes):
+        result = defaultdict(lambda: ([], []))
+        with self.lock:
+            for d_id, changes in all_changes.items():
+                for chat_id in self.deptos.get(d_id, ()):
+                    result[chat_id][0].append(d_id)
+                for kind in ("added", "deleted", "modified"):
+                    for c_id in changes.get(kind, ()):
+                        for chat_id in self.cursos.get((d_id, c_id), ()):
+                            result[chat_id][1].append((d_id, c_id))
+        return dict(result)
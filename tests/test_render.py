@@ -0,0 +1,91 @@
+import re
+
+from hypothesis import assume, given, settings, strategies as st
+
+from render import MAX_ENTITY_LENGTH, TAG_RE, split_message
+
+LINK = "<a href='https://ucampus.uchile.cl/m/fcfm_catalogo/?semestre=20221&depto=5'>\U0001F50D Ver catálogo</a>"
+
+words = st.sampled_from(["Cátedra", "Lunes", "10:15", "-", "S1", "cupos", "&amp;", "&lt;", "&#x1F50D;", "x" * 60, " "])
+html = st.recursive(
+    st.one_of(words, st.just("\n"), st.just(LINK)),
+    lambda children: st.one_of(
+        st.lists(children, min_size=1, max_size=8).map("".join),
+        st.tuples(st.sampled_from(["b", "i", "strong", "u", "code"]), children).map(
+            lambda tag: "<{0}>{1}</{0}>".format(*tag))),
+    max_leaves=60)
+
+
+def nested(depth, text):
+    tags = ["strong", "b", "i", "u"]
+    opening = "".join("<{}>".format(tags[i % len(tags)]) for i in range(depth))
+    closing = "".join("</{}>".format(tags[i % len(tags)]) for i in reversed(range(depth)))
+    return opening + text + closing
+
+
+def plain(text):
+    return TAG_RE.sub("", text).replace("\n", "")
+
+
+def visible(text):
+    return re.sub(r"\s", "", plain(text))
+
+
+def check_chunks(text, chunks, max_length):
+    for chunk in chunks:
+        assert len(chunk) <= max_length
+        assert plain(chunk).strip()
+        stack = []
+        for match in TAG_RE.finditer(chunk):
+            if match.group(1):
+                assert stack and stack[-1] == match.group(2), chunk
+                stack.pop()
+            else:
+                stack.append(match.group(2))
+        assert not stack, chunk
+        assert "<" not in plain(chunk) and ">" not in plain(chunk), chunk
+        if max_length >= MAX_ENTITY_LENGTH:
+            assert not re.search(r"&[#a-zA-Z0-9]*$", plain(chunk)), chunk
+            assert not re.match(r"^[#a-zA-Z0-9]*;", plain(chunk)), chunk
+    assert "".join(map(visible, chunks)) == visible(text)
+
+
+def test_short_text_is_not_split():
+    text = nested(3, "hola\nchao")
+    assert split_message(text, len(text)) == [text]
+
+
+def test_cuts_at_last_newline():
+    assert split_message("uno dos\ntres cuatro\ncinco", 20) == ["uno dos\ntres cuatro", "cinco"]
+
+
+def test_reopens_tags_after_cut():
+    chunks = split_message("<b>" + "x" * 30 + "</b>", 17)
+    assert chunks == ["<b>" + "x" * 10 + "</b>"] * 3
+    check_chunks("<b>" + "x" * 30 + "</b>", chunks, 17)
+
+
+def test_nested_tags_longer_than_limit():
+    text = "<strong><b>" + "abcdefghij" * 3 + "</b></strong> fin"
+    chunks = split_message(text, 15)
+    check_chunks(text, chunks, 15)
+
+
+def test_tag_longer_than_limit_is_omitted_not_cut():
+    chunks = split_message(LINK + " texto", 20)
+    assert "".join(chunks) == "\U0001F50D Ver catálogo texto"
+
+
+@given(html, st.integers(min_value=1, max_value=300))
+@settings(max_examples=500, deadline=None)
+def test_random_html(text, max_length):
+    assume(visible(text))
+    check_chunks(text, split_message(text, max_length), max_length)
+
+
+@given(st.integers(min_value=1, max_value=60), st.integers(min_value=1, max_value=80), html)
+@settings(max_examples=300, deadline=None)
+def test_deep_nesting(depth, max_length, text):
+    assume(visible(text))
+    text = nested(depth, text + "\n" + text)
+    check_chunks(text, split_message(text, max_length), max_length)
@@ -1,113 +1,119 @@
+import asyncio
 import json
 import os
-from telegram import TelegramError, constants as tg_constants
-from telegram.error import BadRequest, Unauthorized, ChatMigrated
+import tempfile
+import time
+from telegram import TelegramError
+from telegram.error import BadRequest, Unauthorized, ChatMigrated, RetryAfter
 
 import data
 from config.logger import logger
 from data import dp
+from metrics import MESSAGES_SENT, TELEGRAM_ERRORS
+from render import split_message
 
 
 class AllDeletedException(Exception):
     pass
 
 
-def full_strip(st):
-    return st.replace("\n", "").replace("\t", "").strip(" ")
-
-
-def parse_horario(horarios_str):
-    result = {"catedra": [],
-              "auxiliar": [],
-              "control": [[], []]}
-    for el in horarios_str:
-        if not isinstance(el, str):
-            continue
-        el = full_strip(el)
-        if el.startswith("Cátedra"):
-            result["catedra"] = el.lstrip("Cátedra: ").split(", ")
-        elif el.startswith("Auxiliar"):
-            result["auxiliar"] = el.lstrip("Auxiliar: ").split(", ")
-        elif el.startswith("Control"):
-            controlsplit = el.split(", Semana: ")
-            result["control"][0] = controlsplit[0].lstrip("Control: ").split(", ")
-            result["control"][1] = controlsplit[1].split(", ") if len(controlsplit) > 1 else []
-    return result
-
-
-def horarios_to_string(horarios, indent):
-    result = ""
-    if len(horarios["catedra"]) > 0:
-        result += (" " * indent) + "<i>Cátedra: {}</i>\n".format(", ".join(horarios["catedra"]))
-    if len(horarios["auxiliar"]) > 0:
-        result += (" " * indent) + "<i>Auxiliar: {}</i>\n".format(", ".join(horarios["auxiliar"]))
-    if len(horarios["control"][0]) > 0:
-        result += (" " * indent) + "<i>Control: {}</i>\n".format(", ".join(horarios["control"][0]))
-    if len(horarios["control"][1]) > 0:
-        result += (" " * indent) + "<i>Semanas {}</i>\n".format(", ".join(horarios["control"][1]))
-    return result
+# El Dispatcher sólo guarda el chat_data del chat de cada update (y el de todos al detenerse), así que los
+# cambios al chat_data de otros chats se deben guardar explícitamente
+def save_chat_data(chat_id):
+    if dp.persistence is not None:
+        dp.persistence.update_chat_data(chat_id, dp.chat_data[chat_id])
 
 
-def try_msg(bot, attempts=2, **params):
+# Maneja un error de Telegram al enviar un mensaje (común a try_msg y try_msg_async). Entrega cuántos segundos
+# esperar antes de reintentar, o None si no hay que reintentar. Los BadRequest se vuelven a lanzar.
+def _on_send_error(e, params, attempt, attempts):
     chat_id = params["chat_id"]
+    TELEGRAM_ERRORS.inc(type=type(e).__name__)
+    if isinstance(e, Unauthorized):
+        logger.error("Chat %s blocked the bot. Aborting message and disabling for this chat.", chat_id)
+        dp.chat_data[chat_id]["enable"] = False
+        save_chat_data(chat_id)
+        data.subscriptions.remove_chat(chat_id)
+        return None
+    if isinstance(e, ChatMigrated):
+        logger.info("Chat %s migrated to supergroup %s. Updating in database.", chat_id, e.new_chat_id)
+        dp.chat_data[e.new_chat_id] = dp.chat_data[chat_id]
+        save_chat_data(e.new_chat_id)
+        data.subscriptions.remove_chat(chat_id)
+        data.subscriptions.update_chat(e.new_chat_id, dp.chat_data[e.new_chat_id])
+        params["chat_id"] = e.new_chat_id
+        return 0
+    if isinstance(e, RetryAfter):
+        logger.warning("[Attempt %s/%s] Flood limit reached when messaging chat %s. Retrying in %s s.",
+                       attempt, attempts, chat_id, e.retry_after)
+        return e.retry_after
+    if isinstance(e, BadRequest):
+        logger.error("Messaging chat %s raised BadRequest: %s. Aborting message.", chat_id, e)
+        raise e
+    logger.error("[Attempt %s/%s] Messaging chat %s raised following error: %s: %s",
+                 attempt, attempts, chat_id, type(e).__name__, e)
+    return 0
+
+
+def try_msg(bot, attempts=2, **params):
     attempt = 1
     while attempt <= attempts:
         try:
             bot.send_message(**params)
-        except Unauthorized:
-            logger.error("Chat %s blocked the bot. Aborting message and disabling for this chat.", chat_id)
-            dp.chat_data[chat_id]["enable"] = False
-            break
-        except ChatMigrated as e:
-            logger.info("Chat %s migrated to supergroup %s. Updating in database.", chat_id, e.new_chat_id)
-            dp.chat_data[e.new_chat_id] = dp.chat_data[chat_id]
-            params["chat_id"] = e.new_chat_id
-            attempt -= 1
-        except BadRequest as e:
-            logger.error("Messaging chat %s raised BadRequest: %s. Aborting message.", chat_id, e)
-            raise
+            MESSAGES_SENT.inc()
+            return
         except TelegramError as e:
-            logger.error("[Attempt %s/%s] Messaging chat %s raised following error: %s: %s",
-                         attempt, attempts, chat_id, type(e).__name__, e)
-        else:
-            break
+            delay = _on_send_error(e, params, attempt, attempts)
+            if delay is None:
+                return
+            if isinstance(e, ChatMigrated):
+                attempt -= 1
+            time.sleep(delay)
         attempt += 1
+    logger.error("Max attempts reached for chat %s. Aborting message.", str(params["chat_id"]))
 
-    if attempt > attempts:
-        logger.error("Max attempts reached for chat %s. Aborting message.", str(chat_id))
+
+# Igual que try_msg, para un bot asíncrono (ver async_bot.py), salvo que si se agotan los intentos lanza el último
+# error en vez de descartar el mensaje, para que quien llama lo reintente más tarde (ver Notifier)
+async def try_msg_async(bot, attempts=2, **params):
+    attempt = 1
+    while True:
+        try:
+            await bot.send_message(**params)
+            MESSAGES_SENT.inc()
+            return
+        except TelegramError as e:
+            delay = _on_send_error(e, params, attempt, attempts)
+            if delay is None:
+                return
+            if isinstance(e, ChatMigrated):
+                attempt -= 1
+            elif attempt >= attempts:
+                logger.error("Max attempts reached for chat %s.", str(params["chat_id"]))
+                raise
+            await asyncio.sleep(delay)
+        attempt += 1
 
 
 def send_long_message(bot, **params):
-    text = params.pop("text", "")
-    maxl = tg_constants.MAX_MESSAGE_LENGTH
-    if len(text) > maxl:
-        slice_index = maxl
-        for i in range(maxl, -1, -1):
-            if text[i] == "\n":
-                slice_index = i
-                break
-        sliced_text = text[:slice_index]
-        rest_text = text[slice_index + 1:]
-        try_msg(bot, text=sliced_text, **params)
-        send_long_message(bot, text=rest_text, **params)
-    else:
-        try_msg(bot, text=text, **params)
-
-
-def notify_thread(context, chat_id, deptos_messages, cursos_messages):
-    if dp.chat_data[chat_id].get("enable", False):
-        for deptos_message in deptos_messages:
-            send_long_message(context.bot,
-                              chat_id=chat_id,
-                              parse_mode="HTML",
-                              disable_web_page_preview=True,
-                              text=deptos_message)
-        for curso_message in cursos_messages:
-            send_long_message(context.bot,
-                              chat_id=chat_id,
-                              parse_mode="HTML",
-                              disable_web_page_preview=True,
-                              text=curso_message)
+    for chunk in split_message(params.pop("text", "")):
+        try_msg(bot, text=chunk, **params)
+
+
+def send_file(bot, chat_id, file_path, filename):
+    with open(file_path, 'rb') as document:
+        bot.send_document(chat_id=chat_id, document=document, filename=filename)
+
+
+# Envía como documento lo que write(archivo) escriba en un archivo temporal (de texto, o binario si binary)
+def send_generated_file(bot, chat_id, filename, write, binary=False):
+    with tempfile.NamedTemporaryFile(delete=False, mode="w+b" if binary else "w+t") as temp_file:
+        temp_filename = temp_file.name
+        write(temp_file)
+    try:
+        send_file(bot, chat_id, temp_filename, filename)
+    finally:
+        os.remove(temp_filename)
 
 
 def save_config():